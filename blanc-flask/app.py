@@ -20,6 +20,7 @@ from firebase_admin import credentials
 from flask import Flask
 from flask_mongoengine import MongoEngine
 from shared import sms_service
+from shared import user_loader
 from pathlib import Path
 from pymongo import monitoring
 
@@ -97,6 +98,8 @@ def create_app(config=None, mongo=True, firebase=True) -> Flask:
     app.register_blueprint(verifications_blueprint)
     app.register_blueprint(admin_blueprint)
     app.register_blueprint(report_blueprint)
+    # users loaded in a request are not carried over to the next one.
+    app.teardown_request(user_loader.teardown)
 
     if mongo:
         init_mongo(app)
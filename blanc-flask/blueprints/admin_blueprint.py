@@ -7,6 +7,8 @@ from flask import Response
 from flask import request
 from model.models import Admin, User, Alarm, Post
 from shared import message_service
+from shared import push_outbox
+from shared import user_card_cache
 from shared.json_encoder import encode
 
 admin_blueprint = Blueprint("admin_blueprint", __name__)
@@ -134,6 +136,7 @@ def route_approve_users(user_id: str):
     user.status = User.Status.APPROVED
     user.available = True
     user.save()
+    user.publish_change()
 
     message_service.push(dict(event=Alarm.Event.APPROVED), user)
 
@@ -154,6 +157,7 @@ def route_reject_users(user_id: str):
     user.status = User.Status.REJECTED
     user.available = False
     user.save()
+    user.publish_change()
 
     message_service.push(dict(event=Alarm.Event.REJECTED), user)
 
@@ -174,7 +178,34 @@ def route_block_users(user_id: str):
     user.status = User.Status.BLOCKED
     user.available = False
     user.save()
+    user.publish_change()
 
     message_service.push(dict(event=Alarm.Event.BLOCKED), user)
 
     return Response("", mimetype="application/json")
+
+
+@admin_blueprint.route("/admin/caches", methods=["GET"])
+def route_get_cache_stats():
+    """Retrieves hit rates of the caches of this worker."""
+
+    uid = request.headers.get("uid", None)
+    admin = Admin.objects.get_or_404(uid=uid)
+    if not admin.available:
+        abort(401)
+
+    response = encode(dict(user_cards=user_card_cache.stats()))
+    return Response(response, mimetype="application/json")
+
+
+@admin_blueprint.route("/admin/pushes", methods=["GET"])
+def route_get_push_stats():
+    """Retrieves the push outbox depth and the dispatch counts of this worker."""
+
+    uid = request.headers.get("uid", None)
+    admin = Admin.objects.get_or_404(uid=uid)
+    if not admin.available:
+        abort(401)
+
+    response = encode(push_outbox.stats())
+    return Response(response, mimetype="application/json")
@@ -3,12 +3,14 @@
 import json
 import mongoengine
 
+from flask import abort
 from flask import current_app as app
 from flask import Blueprint
 from flask import request
 from flask import Response
 
 from model.models import Alarm, User
+from model.models import ALARM_RECORDS_LIMIT
 
 alarms_blueprint = Blueprint('alarms_blueprint', __name__)
 
@@ -19,16 +21,17 @@ def list_alarms():
 
     user = User.objects.get_or_404(uid=uid)
 
-    alarm = Alarm.objects(owner=user).first()
-    if not alarm:
-        alarm = Alarm(owner=user, records=[]).save()
-
-    records = alarm.records
+    before = request.args.get("before", None)
+    # no more records than this are kept.
+    limit = min(max(request.args.get("limit", ALARM_RECORDS_LIMIT, type=int), 1), ALARM_RECORDS_LIMIT)
+    records = Alarm.list_records(user, before=before, limit=limit)
+    # the cards of the senders are loaded by a single query.
+    cards = User.list_cards({push.user_id for push in records})
 
     result = []
     for push in records:
         try:
-            push_dict: dict = push.as_dict()
+            push_dict: dict = push.as_dict(cards.get(str(push.user_id), None))
             result.append(push_dict)
         except mongoengine.DoesNotExist:
             nickname = user.nickname
@@ -41,17 +44,29 @@ def list_alarms():
     return Response(json.dumps(result), mimetype='application/json')
 
 
+@alarms_blueprint.route('/alarms/unread_count', methods=['GET'])
+def get_unread_count():
+    uid = request.headers.get("uid", None)
+
+    user = User.objects.get_or_404(uid=uid)
+
+    unread_count = Alarm.get_unread_count(user)
+    return Response(json.dumps(dict(unread_count=unread_count)), mimetype='application/json')
+
+
 @alarms_blueprint.route('/alarms', methods=['PUT'])
 def update_all_alarms_as_read():
     uid = request.headers.get("uid", None)
 
     user = User.objects.get_or_404(uid=uid)
 
-    alarm = Alarm.objects.get_or_404(owner=user)
-    records = alarm.records
-
-    for push in records:
-        push.is_read = True
+    up_to = request.args.get("up_to", None)
+    if up_to is not None and not up_to.isdigit():
+        abort(400)
 
-    alarm.save()
+    result = Alarm.mark_read(user, up_to=int(up_to) if up_to is not None else None)
+    if result == Alarm.MarkReadResult.NOT_FOUND:
+        abort(404)
+    if result == Alarm.MarkReadResult.CONFLICT:
+        abort(409)
     return Response("", mimetype='application/json')
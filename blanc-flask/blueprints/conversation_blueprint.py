@@ -1,11 +1,19 @@
+import json
 import pendulum
+import queue
+import threading
+import time
 
+from bson.objectid import ObjectId
 from flask import abort
 from flask import Blueprint
 from flask import Response
 from flask import request
 from model.models import Alarm, AlarmRecord, User, Conversation, EmbeddedMessage
+from model.models import MESSAGES_PER_BUCKET, MESSAGES_PER_PAGE, StreamSubscription
 from shared import message_service
+from shared import session_service
+from shared import stream_hub
 from shared.annotation import id_token_required
 from shared.annotation import time_lapse
 from shared.json_encoder import encode
@@ -15,6 +23,14 @@ conversations_blueprint = Blueprint('conversations_blueprint', __name__)
 BEGIN_CONVERSATION_MESSAGE = "대화가 시작 되었습니다. 🥳🎉😀😂👌❤️😍"
 END_CONVERSATION_MESSAGE = "상대방이 대화를 종료 하였습니다."
 
+MAX_MESSAGES_PER_PAGE = 100
+STREAM_HEARTBEAT = 15  # seconds
+STREAM_TIMEOUT = 60 * 5  # seconds
+# each stream holds a thread of the worker, the rest is left for the other requests.
+STREAM_MAX_PER_WORKER = 16
+
+_stream_slots = threading.BoundedSemaphore(STREAM_MAX_PER_WORKER)
+
 
 @conversations_blueprint.route('/conversations', methods=['POST'])
 def route_create_conversation():
@@ -37,7 +53,7 @@ def route_delete_conversation(conversation_id):
 def route_list_user_conversations():
     uid = request.headers.get("uid", None)
     user = User.objects.get_or_404(uid=uid)
-    conversations = Conversation.objects(participants=user).as_pymongo()
+    conversations = Conversation.list_summaries(user)
 
     user_ids = get_conversation_reference_ids(conversations)
     users_dict = User.get_users_dict(user_ids)
@@ -49,6 +65,7 @@ def route_list_user_conversations():
         if None not in participants and None not in references:
             conversation["participants"] = participants
             conversation["references"] = references
+            conversation["unread_count"] = conversation.get("unread_counts", {}).get(str(user.id), 0)
             converted.append(conversation)
 
     response = encode(converted)
@@ -59,17 +76,104 @@ def route_list_user_conversations():
 def route_get_conversation(conversation_id):
     uid = request.headers.get("uid", None)
     user = User.objects.get_or_404(uid=uid)
-    conversation = Conversation.objects.get_or_404(id=conversation_id, participants=user).to_mongo()
+    conversation_object = Conversation.objects.get_or_404(id=conversation_id, participants=user)
+    conversation = conversation_object.to_mongo()
 
     user_ids = get_conversation_reference_ids([conversation])
     user_index = User.get_users_dict(user_ids)
     conversation["participants"] = [user_index.get(str(user_id), None) for user_id in conversation["participants"]]
     conversation["references"] = [user_index.get(str(user_id), None) for user_id in conversation["references"]]
+    # the latest ones in order, the older ones are paged by the message history.
+    conversation["messages"] = conversation_object.list_messages(limit=MESSAGES_PER_BUCKET)[::-1]
+    conversation_object.mark_read(user)
 
     response = encode(conversation)
     return Response(response, mimetype="application/json")
 
 
+@conversations_blueprint.route('/conversations/<conversation_id>/messages', methods=['GET'])
+def route_list_messages(conversation_id: str):
+    """Lists messages older than `before` newest first, or newer than `since` oldest first."""
+    uid = request.headers.get("uid", None)
+    user = User.objects.get_or_404(uid=uid)
+    conversation = Conversation.objects.exclude("messages").get_or_404(id=conversation_id, participants=user)
+
+    before = request.args.get("before", None)
+    since = request.args.get("since", None)
+    if any(cursor and not ObjectId.is_valid(cursor) for cursor in (before, since)):
+        abort(400)
+    limit = min(max(request.args.get("limit", MESSAGES_PER_PAGE, type=int), 1), MAX_MESSAGES_PER_PAGE)
+
+    if since:
+        messages = conversation.list_messages_since(since, limit=limit + 1)
+    else:
+        messages = conversation.list_messages(before=before, limit=limit + 1)
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+
+    # read up to the latest one.
+    if not before and not (since and has_more):
+        conversation.mark_read(user)
+
+    response = encode(dict(messages=messages, next=str(messages[-1]["id"]) if has_more else None))
+    return Response(response, mimetype="application/json")
+
+
+@conversations_blueprint.route('/conversations/<conversation_id>/stream', methods=['GET'])
+def route_stream_conversation(conversation_id: str):
+    """Streams messages of the conversation as server-sent events, from the `Last-Event-ID` on reconnection."""
+    uid = request.headers.get("uid", None)
+    user = User.objects.get_or_404(uid=uid)
+    conversation = Conversation.objects.exclude("messages").get_or_404(id=conversation_id, participants=user)
+    last_event_id = request.headers.get("Last-Event-ID", None)
+    if last_event_id and not ObjectId.is_valid(last_event_id):
+        abort(400)
+
+    # the client retries later, falling back to polling the messages.
+    if not _stream_slots.acquire(blocking=False):
+        abort(503)
+
+    hub = stream_hub.get()
+    try:
+        StreamSubscription.beat(conversation.id, user.id)
+        # subscribed ahead of catching up not to miss ones in between, the client drops duplicates by the id.
+        subscriber = hub.subscribe(conversation.id)
+    except Exception:
+        StreamSubscription.leave(conversation.id, user.id)
+        _stream_slots.release()
+        raise
+
+    def generate():
+        if last_event_id:
+            for message in conversation.list_messages_since(last_event_id, limit=MESSAGES_PER_BUCKET):
+                yield to_event(dict(event=Alarm.Event.CONVERSATION, conversation_id=str(conversation.id),
+                                    message_id=str(message["id"]), **encode_message(message)))
+        # the client reconnects when it ends, which bounds the threads held by gone clients.
+        closes_at = time.time() + STREAM_TIMEOUT
+        beats_at = time.time() + STREAM_HEARTBEAT
+        while time.time() < closes_at:
+            try:
+                yield to_event(subscriber.get(timeout=max(beats_at - time.time(), 0)))
+            except queue.Empty:
+                pass
+            # beats on schedule even while events keep coming.
+            if time.time() >= beats_at:
+                StreamSubscription.beat(conversation.id, user.id)
+                yield ": heartbeat\n\n"
+                beats_at = time.time() + STREAM_HEARTBEAT
+
+    def close():
+        hub.unsubscribe(conversation.id, subscriber)
+        StreamSubscription.leave(conversation.id, user.id)
+        _stream_slots.release()
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    response = Response(generate(), mimetype="text/event-stream", headers=headers)
+    # called by the server even if the generator is never started.
+    response.call_on_close(close)
+    return response
+
+
 @conversations_blueprint.route('/conversations/<conversation_id>/messages/<message>', methods=['POST'])
 def route_create_message(conversation_id: str, message: str):
     uid = request.headers.get("uid", None)
@@ -83,8 +187,7 @@ def route_create_message(conversation_id: str, message: str):
         message=message,
         created_at=pendulum.now().int_timestamp
     )
-    conversation.messages.append(embedded_message)
-    conversation.save()
+    conversation.add_message(embedded_message)
 
     user_from = user
     user_image = next(iter(user.user_images or []), None)
@@ -92,22 +195,17 @@ def route_create_message(conversation_id: str, message: str):
 
     user_to_list = [p for p in conversation.participants if p.id != user.id]
 
-    for user_to in user_to_list:
-        message_service.push(
-            dict(
-                event=Alarm.Event.CONVERSATION,
-                nickname=user_from.nickname,
-                user_id=str(user_from.id),
-                image_url=image_url,
-                created_at=str(pendulum.now().int_timestamp),
-                conversation_id=str(conversation.id),
-                message_id=str(embedded_message.id),
-                message=str(embedded_message.message),
-                category="MESSAGE",
-            ),
-            user_to,
-            priority="high"
-        )
+    deliver(conversation, dict(
+        event=Alarm.Event.CONVERSATION,
+        nickname=user_from.nickname,
+        user_id=str(user_from.id),
+        image_url=image_url,
+        created_at=str(pendulum.now().int_timestamp),
+        conversation_id=str(conversation.id),
+        message_id=str(embedded_message.id),
+        message=str(embedded_message.message),
+        category="MESSAGE",
+    ), user_to_list)
 
     response = encode(embedded_message.to_mongo())
     return Response(response, mimetype="application/json")
@@ -129,6 +227,7 @@ def route_update_conversation_available(conversation_id: str, available: bool):
     else:
         # it will raise exception when remaining point is not enough
         user_to_open_room.consume(5)
+        session_service.invalidate(user_to_open_room)
 
     conversation.available = bool(available)
     conversation.available_at = pendulum.now().int_timestamp
@@ -141,8 +240,8 @@ def route_update_conversation_available(conversation_id: str, available: bool):
         created_at=pendulum.now().int_timestamp
     )
 
-    conversation.messages.append(embedded_message)
     conversation.save()
+    conversation.add_message(embedded_message)
 
     # push opened message
     for user_to in conversation.participants:
@@ -160,19 +259,14 @@ def route_update_conversation_available(conversation_id: str, available: bool):
         message_service.push(data, user_to, priority="high")
 
     # push system message as conversation message
-    for participant in conversation.participants:
-        message_service.push(
-            dict(
-                event=Alarm.Event.CONVERSATION,
-                created_at=str(pendulum.now().int_timestamp),
-                conversation_id=str(conversation.id),
-                message_id=str(embedded_message.id),
-                category="SYSTEM",
-                message=BEGIN_CONVERSATION_MESSAGE
-            ),
-            participant.device_token,
-            priority="high"
-        )
+    deliver(conversation, dict(
+        event=Alarm.Event.CONVERSATION,
+        created_at=str(pendulum.now().int_timestamp),
+        conversation_id=str(conversation.id),
+        message_id=str(embedded_message.id),
+        category="SYSTEM",
+        message=BEGIN_CONVERSATION_MESSAGE
+    ), conversation.participants)
 
     return Response("", mimetype="application/json")
 
@@ -195,24 +289,24 @@ def route_leave_conversation(conversation_id: str, user_id: str):
         created_at=pendulum.now().int_timestamp
     )
 
-    conversation.update(pull__participants=user, push__messages=embedded_message)
+    conversation.update(pull__participants=user)
+    conversation.add_message(embedded_message)
     conversation.reload()
 
     if not conversation.participants:
         conversation.delete()
         return Response("", mimetype="application/json")
 
-    for participant in conversation.participants:
-        message_data = dict(
-            event=Alarm.Event.CONVERSATION,
-            created_at=str(pendulum.now().int_timestamp),
-            conversation_id=str(conversation.id),
-            message_id=str(embedded_message.id),
-            category="SYSTEM",
-            message=END_CONVERSATION_MESSAGE
-        )
-        message_service.push(message_data, participant, priority="high")
+    deliver(conversation, dict(
+        event=Alarm.Event.CONVERSATION,
+        created_at=str(pendulum.now().int_timestamp),
+        conversation_id=str(conversation.id),
+        message_id=str(embedded_message.id),
+        category="SYSTEM",
+        message=END_CONVERSATION_MESSAGE
+    ), conversation.participants)
 
+    for participant in conversation.participants:
         leave_data = AlarmRecord(
             event=Alarm.Event.CONVERSATION_LEAVE,
             user_id=user_id,
@@ -233,3 +327,25 @@ def get_conversation_reference_ids(conversations):
         for user_id in references:
             user_ids.add(user_id)
     return user_ids
+
+
+def deliver(conversation: Conversation, data: dict, users: list):
+    """Publishes the data to the streams of the conversation, pushing it to the users not streaming it."""
+    stream_hub.get().publish(conversation.id, data)
+    streaming_user_ids = StreamSubscription.list_streaming_user_ids(conversation.id)
+    for user in users:
+        if user.id not in streaming_user_ids:
+            message_service.push(data, user, priority="high")
+
+
+def encode_message(message: dict) -> dict:
+    return dict(
+        user_id=str(message.get("user_id") or ""),
+        created_at=str(message.get("created_at")),
+        category=message.get("category"),
+        message=message.get("message"),
+        url=message.get("url") or "")
+
+
+def to_event(data: dict) -> str:
+    return "id: {0}\nevent: {1}\ndata: {2}\n\n".format(data.get("message_id", ""), data.get("event"), json.dumps(data))
@@ -5,6 +5,7 @@ from flask import Blueprint
 from flask import Response
 from flask import request
 from model.models import User, Payment
+from shared import session_service
 from shared.annotation import id_token_required
 from shared.purchase import verify_android_purchase_token, decode_receipt, get_amount
 
@@ -14,14 +15,9 @@ payment_blueprint = Blueprint("payment_blueprint", __name__)
 @payment_blueprint.route("/payments/users/<user_id>/amount", methods=["GET"])
 def route_get_amount(user_id: str):
     user = User.objects.get_or_404(id=user_id)
-    payments = Payment.objects(owner=user).as_pymongo()
+    amount = user.get_current_amount_of_point()
 
-    amount_sum = 0
-
-    for payment in payments:
-        amount_sum += payment.get("amount")
-
-    response = json.dumps(dict(amount=amount_sum))
+    response = json.dumps(dict(amount=amount))
     return Response(response, mimetype="application/json")
 
 
@@ -46,6 +42,7 @@ def route_payment_purchase_android(user_id: str, product_id: str, purchase_token
         amount=amount,
         purchase_time=purchase_result.purchase_time
     )
+    session_service.invalidate(user)
 
     response = json.dumps(dict(result=True))
     return Response(response, mimetype="application/json")
@@ -87,6 +84,7 @@ def route_payment_purchase_ios(user_id: str):
         created_at=created_at,
         purchase_time_ms=purchase_date_ms
     )
+    session_service.invalidate(user)
 
     response = json.dumps(dict(result=purchase_result))
     return Response(response, mimetype="application/json")
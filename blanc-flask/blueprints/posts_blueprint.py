@@ -2,18 +2,22 @@ import json
 import uuid
 import pendulum
 
+from bson.objectid import ObjectId
 from flask import abort
 from flask import Blueprint
 from flask import Response
 from flask import request
 from firebase_admin import storage
 from model.models import Alarm, AlarmRecord, User, Post, Comment, Resource
+from model.models import COMMENTS_PER_POST
 from shared import message_service
 from shared.annotation import time_lapse
 from shared.json_encoder import encode
 
 posts_blueprint = Blueprint('posts_blueprint', __name__)
 
+MAX_COMMENTS_PER_PAGE = 100
+
 
 @posts_blueprint.route('/posts', methods=['POST'])
 def route_create_post():
@@ -113,7 +117,7 @@ def route_create_favorite(post_id: str):
     user_from = user
     user_to = post.author
 
-    alarm = Alarm.create_alarm(
+    alarm_record: AlarmRecord = Alarm.create_alarm(
         user_from=user_from,
         user_to=user_to,
         event=Alarm.Event.POST_FAVORITE,
@@ -121,7 +125,6 @@ def route_create_favorite(post_id: str):
         message="{nickname} 님이 당신의 게시물을 좋아합니다.".format(nickname=user_from.nickname)
     )
 
-    alarm_record: AlarmRecord = alarm.records[-1]
     data: dict = alarm_record.as_dict()
     message_service.push(data, user_to)
 
@@ -159,13 +162,14 @@ def route_create_comment(post_id: str):
         user_id=user.id,
         comment=comment,
         comments=[],  # child comments
+        parent_id=comment_id or None,
         created_at=pendulum.now().int_timestamp,
         is_deleted=False
     ).save()
 
     post.add_comment(comment_to_create, parent_id=comment_id)
 
-    alarm = Alarm.create_alarm(
+    alarm_record = Alarm.create_alarm(
         user_from=user,
         user_to=post.author,
         event=Alarm.Event.COMMENT,
@@ -173,7 +177,6 @@ def route_create_comment(post_id: str):
         comment=comment_to_create,
         message="{nickname} 님이 당신의 게시물에 댓글을 남겼습니다.".format(nickname=user.nickname))
 
-    alarm_record = alarm.records[-1]
     data = alarm_record.as_dict()
     message_service.push(data, post.author)
 
@@ -184,6 +187,20 @@ def route_create_comment(post_id: str):
     return Response(response, mimetype="application/json")
 
 
+@posts_blueprint.route('/posts/<post_id>/comments', methods=['GET'])
+def route_list_comments(post_id: str):
+    """Lists the top level comments older than the cursor, given as `comments_next` of a post or `next`."""
+    if not ObjectId.is_valid(post_id):
+        abort(404)
+    cursor = request.args.get("cursor", None)
+    if cursor and Comment.parse_cursor(cursor) is None:
+        abort(400)
+    limit = min(max(request.args.get("limit", COMMENTS_PER_POST, type=int), 1), MAX_COMMENTS_PER_PAGE)
+    result = Comment.list_more_comments(post_id, cursor=cursor, limit=limit)
+    response = encode(result)
+    return Response(response, mimetype="application/json")
+
+
 @posts_blueprint.route('/posts/<post_id>/comments/<comment_id>/thumb_up', methods=['POST'])
 def route_create_thumb_up(post_id, comment_id):
     uid = request.headers.get("uid", None)
@@ -206,14 +223,13 @@ def route_create_thumb_up(post_id, comment_id):
         user_from = user
         user_to = User.get(id=comment.user_id)
 
-        alarm = Alarm.create_alarm(
+        alarm_record = Alarm.create_alarm(
             user_from=user_from,
             user_to=user_to,
             event=Alarm.Event.COMMENT_THUMB_UP,
             post=post,
             comment=comment,
             message="{nickname} 님이 당신의 댓글을 좋아합니다.".format(nickname=user_from.nickname))
-        alarm_record = alarm.records[-1]
         data = alarm_record.as_dict()
         message_service.push(data, user_to)
 
@@ -8,6 +8,7 @@ from flask import Response
 from flask import request
 from model.models import Alarm, Request, User, Conversation
 from shared import message_service
+from shared import session_service
 from shared.annotation import id_token_required, time_lapse
 from shared.json_encoder import encode
 
@@ -78,6 +79,9 @@ def route_create_request(user_id: str, r_type: int):
     _request.save()
     _request.reload()
 
+    user_from.exclude(user_to)
+    user_to.exclude(user_from)
+
     # if the target exists in recommendation, remove them.
     user_from.remove_user_from_recommendation(user_to)
 
@@ -86,13 +90,14 @@ def route_create_request(user_id: str, r_type: int):
     else:
         user_from.consume(5)
 
-    alarm = Alarm.create_alarm(
+    session_service.invalidate(user_from, user_to)
+
+    alarm_record = Alarm.create_alarm(
         user_from=user_from,
         user_to=user_to,
         event=Alarm.Event.REQUEST,
         request=_request,
         message="{nickname} 님이 당신에게 친구 신청을 보냈습니다.".format(nickname=user_from.nickname))
-    alarm_record = alarm.records[-1]
     data = alarm_record.as_dict()
     message_service.push(data, user_to)
 
@@ -119,6 +124,10 @@ def route_update_response_of_request(request_id: str, result: int):
     _request.save()
     _request.reload()
 
+    _request.user_to.exclude(_request.user_from)
+    _request.user_from.exclude(_request.user_to)
+    session_service.invalidate(_request.user_to, _request.user_from)
+
     if int(result) == 1:
         _request.user_to.remove_user_from_recommendation(_request.user_from)
 
@@ -135,14 +144,13 @@ def route_update_response_of_request(request_id: str, result: int):
         user_alarm_from = _request.user_to
         user_alarm_to = _request.user_from
 
-        alarm = Alarm.create_alarm(
+        alarm_record = Alarm.create_alarm(
             user_from=user_alarm_from,
             user_to=user_alarm_to,
             event=Alarm.Event.MATCHED,
             request=_request,
             conversation=conversation,
             message="{nickname} 님과 연결 되었습니다.".format(nickname=_request.user_to.nickname))
-        alarm_record = alarm.records[-1]
         data = alarm_record.as_dict()
         message_service.push(data, user_alarm_to)
 
@@ -2,18 +2,26 @@ import firebase_admin
 import json
 import unittest
 import pendulum
+import threading
+import manage
 import mock
 
+from bson.objectid import ObjectId
+from click.testing import CliRunner
 from mongoengine import connect, disconnect
 from app import create_app
 from app import init_firebase
 from blueprints.test.mock_data import *
 from config import UnitTestConfig
-from model.models import User, Conversation
+from model.models import User, Conversation, EmbeddedMessage, MessageBucket, StreamSubscription
+from model import models
 
 from firebase_admin import auth
 from firebase_admin import messaging
-from blueprints.test.test_utils import create_user_1, create_user_2, create_user_3
+from blueprints.test.test_utils import create_user_1, create_user_2, create_user_3, save_user
+from blueprints import conversation_blueprint
+from shared import message_service
+from shared import stream_hub
 
 REQUEST_TYPE_LIKE = 10
 REQUEST_TYPE_FRIEND = 20
@@ -104,13 +112,13 @@ class ConversationsBlueprintTestCase(unittest.TestCase):
         
         conversation = Conversation.objects.first()
         
-        # assert embedded_messages
-        messages = conversation.messages
+        # assert messages in buckets
+        messages = conversation.list_messages()[::-1]
         self.assertEqual(len(messages), 2)
-        self.assertEqual(str(messages[0].user_id), str(user_1.id))
-        self.assertEqual(messages[0].message, first_message)
-        self.assertEqual(str(messages[1].user_id), str(user_1.id))
-        self.assertEqual(messages[1].message, second_message)
+        self.assertEqual(str(messages[0]["user_id"]), str(user_1.id))
+        self.assertEqual(messages[0]["message"], first_message)
+        self.assertEqual(str(messages[1]["user_id"]), str(user_1.id))
+        self.assertEqual(messages[1]["message"], second_message)
         
 
     @mock.patch.object(auth, 'verify_id_token')
@@ -163,6 +171,203 @@ class ConversationsBlueprintTestCase(unittest.TestCase):
         self.assertEqual(participants[0]["nickname"], user_1.nickname)
         self.assertEqual(participants[1]["nickname"], user_2.nickname)
 
+    def test_message_buckets(self):
+        """Should append messages into buckets and list them newest first by the cursor."""
+        user_1 = save_user(mock_user_1)
+        user_2 = save_user(mock_user_2)
+        conversation = Conversation(
+            participants=[user_1, user_2], references=[user_1, user_2], created_at=1).save()
+
+        with mock.patch.object(models, "MESSAGES_PER_BUCKET", 3):
+            for index in range(7):
+                self.app.post("/conversations/{0}/messages/message_{1}".format(conversation.id, index),
+                              headers=dict(uid=user_1.uid))
+        self.assertEqual([bucket.count for bucket in MessageBucket.objects.order_by("last_id")], [3, 3, 1])
+
+        messages = conversation.list_messages(limit=4)
+        self.assertEqual([message["message"] for message in messages], ["message_{0}".format(i) for i in [6, 5, 4, 3]])
+        messages = conversation.list_messages(before=messages[-1]["id"], limit=4)
+        self.assertEqual([message["message"] for message in messages], ["message_{0}".format(i) for i in [2, 1, 0]])
+
+        response = self.app.get("/conversations/{0}".format(conversation.id), headers=dict(uid=user_1.uid))
+        self.assertEqual(len(response.get_json()["messages"]), 7)
+        self.assertEqual(response.get_json()["messages"][0]["message"], "message_0")
+
+        conversation.delete()
+        self.assertEqual(MessageBucket.objects.count(), 0)
+
+    def test_migrate_messages(self):
+        """Should move the embedded messages into buckets in order."""
+        messages = [EmbeddedMessage(message=str(index), created_at=index) for index in range(5)]
+        conversation = Conversation(created_at=1, messages=messages).save()
+
+        with mock.patch.object(models, "MESSAGES_PER_BUCKET", 2):
+            MessageBucket.insert_messages(conversation.id, [message.to_mongo() for message in messages])
+        self.assertEqual([bucket.count for bucket in MessageBucket.objects.order_by("last_id")], [2, 2, 1])
+        self.assertEqual([message["message"] for message in conversation.list_messages()], ["4", "3", "2", "1", "0"])
+
+    def test_list_conversation_summaries(self):
+        """Should list conversations by the last activity with the last message and the unread counts."""
+        user_1 = save_user(mock_user_1)
+        user_2 = save_user(mock_user_2)
+        user_3 = save_user(mock_user_3)
+        conversation_1 = Conversation(participants=[user_1, user_2], references=[user_1, user_2], created_at=1).save()
+        conversation_2 = Conversation(participants=[user_1, user_3], references=[user_1, user_3], created_at=2).save()
+
+        pendulum.set_test_now(pendulum.from_timestamp(10))
+        self.app.post("/conversations/{0}/messages/hello".format(conversation_1.id), headers=dict(uid=user_2.uid))
+        self.app.post("/conversations/{0}/messages/again".format(conversation_1.id), headers=dict(uid=user_2.uid))
+        pendulum.set_test_now()
+
+        conversations = self.app.get("/conversations", headers=dict(uid=user_1.uid)).get_json()
+        self.assertEqual([c["_id"] for c in conversations], [str(conversation_1.id), str(conversation_2.id)])
+        self.assertNotIn("messages", conversations[0])
+        self.assertEqual(conversations[0]["last_message"]["message"], "again")
+        self.assertEqual(conversations[0]["last_activity_at"], 10)
+        self.assertEqual(conversations[0]["unread_count"], 2)
+        self.assertEqual(conversations[0]["unread_counts"], {str(user_1.id): 2})
+
+        self.app.get("/conversations/{0}".format(conversation_1.id), headers=dict(uid=user_1.uid))
+        conversations = self.app.get("/conversations", headers=dict(uid=user_1.uid)).get_json()
+        self.assertEqual(conversations[0]["unread_count"], 0)
+
+    def test_list_messages(self):
+        """Should page the history by before and catch up by since."""
+        user_1 = save_user(mock_user_1)
+        user_2 = save_user(mock_user_2)
+        conversation = Conversation(participants=[user_1, user_2], references=[user_1, user_2], created_at=1).save()
+        with mock.patch.object(models, "MESSAGES_PER_BUCKET", 3):
+            for index in range(7):
+                self.app.post("/conversations/{0}/messages/message_{1}".format(conversation.id, index),
+                              headers=dict(uid=user_2.uid))
+        url = "/conversations/{0}/messages".format(conversation.id)
+        headers = dict(uid=user_1.uid)
+
+        page = self.app.get(url + "?limit=3", headers=headers).get_json()
+        self.assertEqual([m["message"] for m in page["messages"]], ["message_6", "message_5", "message_4"])
+        self.assertEqual(Conversation.objects.get(id=conversation.id).unread_counts[str(user_1.id)], 0)
+        page = self.app.get(url + "?limit=3&before={0}".format(page["next"]), headers=headers).get_json()
+        self.assertEqual([m["message"] for m in page["messages"]], ["message_3", "message_2", "message_1"])
+        oldest = self.app.get(url + "?before={0}".format(page["next"]), headers=headers).get_json()
+        self.assertEqual([m["message"] for m in oldest["messages"]], ["message_0"])
+        self.assertIsNone(oldest["next"])
+
+        page = self.app.get(url + "?limit=4&since={0}".format(oldest["messages"][0]["id"]), headers=headers).get_json()
+        self.assertEqual([m["message"] for m in page["messages"]], ["message_{0}".format(i) for i in [1, 2, 3, 4]])
+        page = self.app.get(url + "?since={0}".format(page["next"]), headers=headers).get_json()
+        self.assertEqual([m["message"] for m in page["messages"]], ["message_5", "message_6"])
+        self.assertIsNone(page["next"])
+
+        page = self.app.get(url + "?limit=0", headers=headers).get_json()
+        self.assertEqual([m["message"] for m in page["messages"]], ["message_6"])
+        page = self.app.get(url + "?limit=invalid", headers=headers).get_json()
+        self.assertEqual(len(page["messages"]), 7)
+        self.assertEqual(self.app.get(url + "?before=bad", headers=headers).status_code, 400)
+        self.assertEqual(self.app.get(url + "?since=bad", headers=headers).status_code, 400)
+
+        response = self.app.get(url, headers=dict(uid=save_user(mock_user_3).uid))
+        self.assertEqual(response.status_code, 404)
+
+    def test_stream_conversation(self):
+        """Should stream messages to the participants streaming, pushing only to the others."""
+        user_1 = save_user(mock_user_1)
+        user_2 = save_user(mock_user_2)
+        conversation = Conversation(participants=[user_1, user_2], references=[user_1, user_2], created_at=1).save()
+        url = "/conversations/{0}".format(conversation.id)
+        first = self.app.post(url + "/messages/first", headers=dict(uid=user_2.uid)).get_json()
+
+        with mock.patch.object(conversation_blueprint, "STREAM_HEARTBEAT", 0.01):
+            response = self.app.get(url + "/stream", headers={"uid": user_1.uid, "Last-Event-ID": first["id"]})
+        self.assertEqual(response.mimetype, "text/event-stream")
+        self.assertEqual(StreamSubscription.list_streaming_user_ids(conversation.id), {user_1.id})
+
+        with mock.patch.object(message_service, "push") as push:
+            self.app.post(url + "/messages/second", headers=dict(uid=user_2.uid))
+            self.app.post(url + "/messages/third", headers=dict(uid=user_1.uid))
+        self.assertEqual([call[0][1].id for call in push.call_args_list], [user_2.id])
+
+        events = (event.decode() for event in response.response if not event.startswith(b": heartbeat"))
+        for message in ["second", "third"]:
+            event = next(events)
+            self.assertTrue(event.startswith("id: "))
+            self.assertEqual(json.loads(event.split("data: ")[1])["message"], message)
+        response.close()
+        self.assertEqual(StreamSubscription.list_streaming_user_ids(conversation.id), set())
+
+    def test_stream_conversation_refused(self):
+        """Should refuse streams of a bad event id or over the cap of the worker, until one is closed."""
+        user_1 = save_user(mock_user_1)
+        user_2 = save_user(mock_user_2)
+        conversation = Conversation(participants=[user_1, user_2], references=[user_1, user_2], created_at=1).save()
+        url = "/conversations/{0}/stream".format(conversation.id)
+
+        response = self.app.get(url, headers={"uid": user_1.uid, "Last-Event-ID": "bad"})
+        self.assertEqual(response.status_code, 400)
+
+        with mock.patch.object(conversation_blueprint, "_stream_slots", threading.BoundedSemaphore(1)), \
+                mock.patch.object(conversation_blueprint, "STREAM_HEARTBEAT", 0.01):
+            response = self.app.get(url, headers={"uid": user_1.uid})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(self.app.get(url, headers={"uid": user_2.uid}).status_code, 503)
+            response.close()
+            self.assertEqual(StreamSubscription.list_streaming_user_ids(conversation.id), set())
+            response = self.app.get(url, headers={"uid": user_2.uid})
+            self.assertEqual(response.status_code, 200)
+            response.close()
+
+    def test_migrate_messages_command(self):
+        """Should move the embedded messages once, even run again after interrupted, removing orphan buckets."""
+        messages = [EmbeddedMessage(message=str(index), created_at=index) for index in range(5)]
+        conversation = Conversation(created_at=1, messages=messages).save()
+
+        MessageBucket.insert_messages(ObjectId(), [EmbeddedMessage(message="orphan", created_at=0).to_mongo()])
+
+        with mock.patch.object(models, "MESSAGES_PER_BUCKET", 2):
+            self.assertEqual(CliRunner().invoke(manage.migrate_messages).exit_code, 0)
+            # interrupted before the embedded ones were dropped, then appended to.
+            Conversation._get_collection().update_one(
+                {"_id": conversation.id}, {"$set": {"messages": [message.to_mongo() for message in messages]}})
+            MessageBucket.push(conversation.id, EmbeddedMessage(message="5", created_at=5))
+            self.assertEqual(CliRunner().invoke(manage.migrate_messages).exit_code, 0)
+
+        listed = conversation.list_messages()
+        self.assertEqual([message["message"] for message in listed], ["5", "4", "3", "2", "1", "0"])
+        self.assertEqual(sum(bucket.count for bucket in MessageBucket.objects), 6)
+        conversation = Conversation._get_collection().find_one({"_id": conversation.id})
+        self.assertNotIn("messages", conversation)
+        self.assertEqual(conversation["last_message"]["message"], "4")
+
+    def test_stream_conversation_failed(self):
+        """Should give back the slot and subscribe nothing when the stream fails to open."""
+        user_1 = save_user(mock_user_1)
+        user_2 = save_user(mock_user_2)
+        conversation = Conversation(participants=[user_1, user_2], references=[user_1, user_2], created_at=1).save()
+        url = "/conversations/{0}/stream".format(conversation.id)
+        slots = threading.BoundedSemaphore(1)
+        hub = stream_hub.LocalHub()
+
+        with mock.patch.object(conversation_blueprint, "_stream_slots", slots), \
+                mock.patch.object(stream_hub, "get", return_value=hub), \
+                mock.patch.object(StreamSubscription, "beat", side_effect=Exception("unavailable")):
+            with self.assertRaises(Exception):
+                self.app.get(url, headers={"uid": user_1.uid})
+        self.assertEqual(hub._subscribers, {})
+        self.assertTrue(slots.acquire(blocking=False))
+
+    def test_delete_message_buckets(self):
+        """Should remove the buckets along with the conversations, deleted by a query or one by one."""
+        user_1 = save_user(mock_user_1)
+        user_2 = save_user(mock_user_2)
+        conversation_1 = Conversation(participants=[user_1, user_2], references=[user_1, user_2], created_at=1).save()
+        conversation_2 = Conversation(participants=[user_1, user_2], references=[user_1, user_2], created_at=2).save()
+        conversation_1.add_message(EmbeddedMessage(message="hello", created_at=1))
+        conversation_2.add_message(EmbeddedMessage(message="hello", created_at=2))
+
+        Conversation.objects(id=conversation_1.id).delete()
+        self.assertEqual([bucket.conversation_id.id for bucket in MessageBucket.objects], [conversation_2.id])
+        conversation_2.delete()
+        self.assertEqual(MessageBucket.objects.count(), 0)
+
 
 if __name__ == "__main__":
     unittest.main()
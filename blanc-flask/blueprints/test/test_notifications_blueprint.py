@@ -1,5 +1,129 @@
+import firebase_admin
+import pendulum
 import unittest
 
+from blueprints.test.mock_data import *
+from config import UnitTestConfig
+from firebase_admin import messaging
+from flask import current_app
+from app import create_app
+from app import init_firebase
+
+from blueprints.test.test_utils import save_user
+from model.models import Alarm, PushOutbox
+from model import models
+from mongoengine import connect, disconnect
+from shared import message_service
+from shared import push_outbox
+from unittest import mock
+
 
 class AlertsBlueprintTestCase(unittest.TestCase):
-    pass
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.firebase_app = init_firebase(UnitTestConfig)
+
+    def setUp(self) -> None:
+        connect('mongoenginetest', host='mongomock://localhost')
+        app = create_app(UnitTestConfig, mongo=False, firebase=False)
+        app.app_context().push()
+        self.app = app.test_client()
+        messaging.send = lambda x: x
+
+    def tearDown(self):
+        disconnect()
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        firebase_admin.delete_app(cls.firebase_app)
+
+    def test_create_alarm(self):
+        """Should push records into the inbox newest first, keeping only the latest ones."""
+        user_1 = save_user(mock_user_1)
+        user_2 = save_user(mock_user_2)
+
+        records = []
+        with mock.patch.object(models, "ALARM_RECORDS_LIMIT", 3):
+            for index in range(5):
+                pendulum.set_test_now(pendulum.from_timestamp(1600000000 + index))
+                records.append(Alarm.create_alarm(
+                    event=Alarm.Event.POKE, user_from=user_1, user_to=user_2, message=str(index)))
+        pendulum.set_test_now()
+
+        alarm = Alarm.objects.get(owner=user_2)
+        self.assertEqual([record.id for record in alarm.records], [record.id for record in records[:1:-1]])
+        self.assertEqual(records[-1].as_dict()["nickname"], user_1.nickname)
+
+    def test_list_alarms(self):
+        """Should list the records by the cursor and count the unread ones."""
+        user_1 = save_user(mock_user_1)
+        user_2 = save_user(mock_user_2)
+        records = []
+        for index in range(5):
+            pendulum.set_test_now(pendulum.from_timestamp(1600000000 + index))
+            records.append(Alarm.create_alarm(
+                event=Alarm.Event.POKE, user_from=user_1, user_to=user_2, message=str(index)))
+        pendulum.set_test_now()
+        headers = dict(uid=user_2.uid)
+
+        response = self.app.get("/alarms?limit=2", headers=headers)
+        self.assertEqual([alarm["message"] for alarm in response.get_json()], ["4", "3"])
+        self.assertEqual(response.get_json()[0]["nickname"], user_1.nickname)
+        response = self.app.get("/alarms?before={0}&limit=2".format(records[3].id), headers=headers)
+        self.assertEqual([alarm["message"] for alarm in response.get_json()], ["2", "1"])
+        response = self.app.get("/alarms?limit=0", headers=headers)
+        self.assertEqual([alarm["message"] for alarm in response.get_json()], ["4"])
+        response = self.app.get("/alarms?limit=invalid", headers=headers)
+        self.assertEqual(len(response.get_json()), 5)
+
+        response = self.app.get("/alarms/unread_count", headers=headers)
+        self.assertEqual(response.get_json(), dict(unread_count=5))
+
+    def test_build_mark_read(self):
+        """Should mark the unread records, up to the timestamp if given, resetting the counter."""
+        update, array_filters = Alarm.build_mark_read()
+        self.assertEqual(update, {"$set": {"records.$[record].is_read": True, "unread_count": 0}})
+        self.assertEqual(array_filters, [{"record.is_read": {"$ne": True}}])
+
+        update, array_filters = Alarm.build_mark_read(up_to=1600000000, unread_count=2)
+        self.assertEqual(update["$set"]["unread_count"], 2)
+        self.assertEqual(array_filters, [{"record.is_read": {"$ne": True}, "record.created_at": {"$lte": 1600000000}}])
+
+    def test_push_outbox(self):
+        """Should queue pushes and send them in batches, retrying failures with backoff."""
+        user_1 = save_user(mock_user_1)
+        user_2 = save_user(mock_user_2)
+        user_2.update(set__device_token=None)
+        current_app.config["PUSH_DISPATCH"] = "outbox"
+        message_service.push(dict(event=Alarm.Event.LOG_OUT), user_1)
+        message_service.push(dict(event=Alarm.Event.LOG_OUT), user_1)
+        current_app.config["PUSH_DISPATCH"] = "inline"
+        PushOutbox.enqueue(user_2, dict(event=Alarm.Event.LOG_OUT))
+        self.assertEqual(PushOutbox.objects(status=PushOutbox.Status.PENDING).count(), 3)
+
+        responses = [mock.Mock(success=True), mock.Mock(success=False, exception=Exception("unavailable"))]
+        with mock.patch.object(messaging, "send_all", create=True) as send_all:
+            send_all.return_value.responses = responses
+            self.assertEqual(push_outbox.dispatch(message_service.build_message), 1)
+        self.assertEqual(len(send_all.call_args[0][0]), 2)
+
+        statuses = sorted((push.status, push.attempts) for push in PushOutbox.objects)
+        self.assertEqual(statuses, [("FAILED", 1), ("PENDING", 1), ("SENT", 1)])
+        retried = PushOutbox.objects.get(status=PushOutbox.Status.PENDING)
+        self.assertGreater(retried.available_at, pendulum.now().naive())
+        self.assertEqual(push_outbox.claim_batch(), [])
+
+    def test_mark_read_without_alarm(self):
+        """Should respond 404 for a user without any alarm, and 400 for a bad timestamp."""
+        user_1 = save_user(mock_user_1)
+
+        self.assertEqual(Alarm.mark_read(user_1, up_to=1600000000), Alarm.MarkReadResult.NOT_FOUND)
+        response = self.app.put("/alarms?up_to=1600000000", headers=dict(uid=user_1.uid))
+        self.assertEqual(response.status_code, 404)
+        response = self.app.put("/alarms?up_to=abc", headers=dict(uid=user_1.uid))
+        self.assertEqual(response.status_code, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
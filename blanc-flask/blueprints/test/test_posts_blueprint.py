@@ -4,11 +4,12 @@ import os
 import mock
 import unittest
 
+from bson.objectid import ObjectId
 from mongoengine import connect, disconnect
 from app import create_app
 from app import init_firebase
 from blueprints.test.mock_data import *
-from blueprints.test.test_utils import create_user_1, create_user_2, create_user_3
+from blueprints.test.test_utils import create_user_1, create_user_2, create_user_3, save_user
 
 from config import UnitTestConfig
 from model.models import Post, Comment, User
@@ -521,6 +522,57 @@ class PostsBlueprintTestCase(unittest.TestCase):
         comment_from_db = Comment.objects.first()
         self.assertEqual(len(comment_from_db.thumb_down_user_ids), 0)
 
+    def test_build_comments_of_posts(self):
+        """Should match the top level comments of the posts at once, capping each post by the limit."""
+        post_ids = [ObjectId(), ObjectId()]
+        pipeline = Comment.build_comments_of_posts(post_ids, limit=2)
+
+        self.assertEqual(pipeline[0], {"$match": {"post_id": {"$in": post_ids}, "parent_id": None}})
+        self.assertEqual(pipeline[1], {"$sort": {"post_id": 1, "created_at": -1, "_id": -1}})
+        self.assertEqual(pipeline[2]["$group"]["comments"], {"$push": "$$ROOT"})
+        self.assertEqual(pipeline[3]["$project"]["comments"], {"$slice": ["$comments", 2]})
+        self.assertEqual(pipeline[-1]["$lookup"]["foreignField"], "parent_id")
+
+    def test_list_comments_by_pages(self):
+        """Should list a page of comments of each post with their replies, and the rest by the cursor."""
+        user_1 = save_user(mock_user_1)
+        user_2 = save_user(mock_user_2)
+        post = Post.create(author=user_1, title="title", description="description", resources=[],
+                           created_at=1, enable_comment=True)
+        comments = [Comment(post_id=post.id, user_id=user_2.id, comment=str(index), created_at=index).save()
+                    for index in range(5)]
+        reply = Comment(post_id=post.id, user_id=user_1.id, parent_id=comments[4].id, comment="reply",
+                        created_at=10).save()
+
+        posts = Post.list_posts(comments_limit=2, id=post.id)
+
+        listed = posts[0]
+        self.assertEqual([comment["comment"] for comment in listed["comments"]], ["4", "3"])
+        self.assertEqual(listed["comments"][0]["comments"][0]["_id"], reply.id)
+        self.assertEqual(listed["comments"][0]["comments"][0]["commenter"]["_id"], user_1.id)
+        self.assertEqual(listed["comments"][1]["commenter"]["_id"], user_2.id)
+        self.assertEqual(listed["author"]["_id"], user_1.id)
+        self.assertEqual(listed["comments_count"], 5)
+
+        response = self.app.get("/posts/{0}/comments?cursor={1}&limit=2".format(post.id, listed["comments_next"]))
+        page = response.get_json()
+        self.assertEqual([comment["comment"] for comment in page["comments"]], ["2", "1"])
+        response = self.app.get("/posts/{0}/comments?cursor={1}&limit=2".format(post.id, page["next"]))
+        page = response.get_json()
+        self.assertEqual([comment["comment"] for comment in page["comments"]], ["0"])
+        self.assertIsNone(page["next"])
+
+        page = self.app.get("/posts/{0}/comments?limit=0".format(post.id)).get_json()
+        self.assertEqual([comment["comment"] for comment in page["comments"]], ["4"])
+        page = self.app.get("/posts/{0}/comments?limit=invalid".format(post.id)).get_json()
+        self.assertEqual(len(page["comments"]), 5)
+
+        response = self.app.get("/posts/{0}/comments?cursor=bad".format(post.id))
+        self.assertEqual(response.status_code, 400)
+        response = self.app.get("/posts/{0}/comments?cursor=1_bad".format(post.id))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.app.get("/posts/nope/comments").status_code, 404)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -10,8 +10,8 @@ from firebase_admin import messaging
 from app import create_app
 from app import init_firebase
 
-from blueprints.test.test_utils import create_user_1, create_user_2, create_user_3
-from model.models import User, Request, Conversation, Payment
+from blueprints.test.test_utils import create_user_1, create_user_2, create_user_3, save_user
+from model.models import User, Request, Conversation, Payment, Balance
 from mongoengine import connect, disconnect
 from unittest import mock
 from werkzeug import exceptions
@@ -411,6 +411,27 @@ class RequestsBlueprintTestCase(unittest.TestCase):
         self.assertEqual(mock_send.call_count, 1)  # should be not called when declined
         self.assertEqual(updated_request.responded_at, pendulum.now().int_timestamp)
 
+    def test_point_balance(self):
+        """Should keep the balance with the ledger, consuming only when it is enough."""
+        user = save_user(mock_user_1)
+        # payments before the balance is materialized.
+        Payment(owner=user, type="PURCHASE", amount=7, created_at=pendulum.now().int_timestamp).save()
+        self.assertEqual(user.get_current_amount_of_point(), 7)
+
+        result = user.purchase(platform="IOS", order_id="order_1", product_id="product_1", amount=3,
+                               created_at=pendulum.now().int_timestamp, purchase_time_ms=1)
+        self.assertEqual(result, Payment.Result.PURCHASED)
+        self.assertEqual(user.get_current_amount_of_point(), 10)
+
+        user.consume(6)
+        self.assertRaises(Exception, user.consume, 5)
+        self.assertEqual(user.get_current_amount_of_point(), 4)
+        self.assertEqual(Balance.sum_payments(user), 4)
+        self.assertEqual(Balance.list_mismatches(), [])
+
+        Balance.objects(owner=user).update_one(set__balance=100)
+        self.assertEqual(Balance.list_mismatches(), [(user.id, 100, 4)])
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -2,23 +2,33 @@ import firebase_admin
 import json
 import os
 import pendulum
+import tempfile
 import unittest
 import io
 import mock
 
+from bson.objectid import ObjectId
 from mongoengine import connect, disconnect
 from app import create_app
 from app import init_firebase
 
 from blueprints.test.mock_data import *
 from blueprints import users_blueprint
-from blueprints.test.test_utils import create_user_1, create_user_2, create_user_3
+from blueprints.test.test_utils import create_user_1, create_user_2, create_user_3, save_user
 
 from config import UnitTestConfig
-from model.models import User, StarRating, Recommendation, Contact, Setting
+from model.models import User, StarRating, Recommendation, Contact, Setting, Exclusion, Request, PhoneIndex
+from model.models import Presence, Sequence, UserChange
 
 from firebase_admin import auth
 from firebase_admin import messaging
+from flask import current_app, g
+from shared import geo_index
+from shared import index_service
+from shared import session_service
+from shared import user_card_cache
+from shared import recommendation_batch
+from shared import scoring
 
 
 class UsersBlueprintTestCase(unittest.TestCase):
@@ -807,5 +817,329 @@ class UsersBlueprintTestCase(unittest.TestCase):
         self.assertEqual(push_setting.conversation, False)
         self.assertEqual(push_setting.lookup, True)
 
+    def test_nin_ids_are_persisted_and_maintained(self):
+        """Should build nin ids once and maintain it incrementally."""
+        user_1 = save_user(mock_user_1)
+        user_2 = save_user(mock_user_2)
+        user_3 = save_user(mock_user_3)
+        Request(user_from=user_2, user_to=user_1, requested_at=pendulum.now().int_timestamp).save()
+
+        self.assertEqual(user_1._get_nin_ids(), {user_2.id})
+        self.assertEqual(Exclusion.objects(owner=user_1).count(), 1)
+
+        user_1.exclude(user_3)
+        self.assertEqual(user_1._get_nin_ids(), {user_2.id, user_3.id})
+
+        user_1.set_contact([])
+        self.assertEqual(Exclusion.objects(owner=user_1).count(), 0)
+        self.assertEqual(user_1._get_nin_ids(), {user_2.id})
+
+    def test_list_user_ids_know_each_other(self):
+        """Should resolve users knowing each other in a batch and record it on both sides."""
+        user_1 = save_user(mock_user_1)
+        user_2 = save_user(mock_user_2)
+        user_3 = save_user(mock_user_3)
+        user_2.set_contact([user_1.phone])
+
+        known_ids = user_1.list_user_ids_know_each_other([user_2.id, user_3.id])
+
+        self.assertEqual(known_ids, {user_2.id})
+        self.assertIn(user_2.id, Contact.objects.get(owner=user_1).user_ids_know_me)
+        self.assertIn(user_1.id, Contact.objects.get(owner=user_2).user_ids_know_me)
+        self.assertEqual(user_1.pick_user_ids_not_knowing([user_2.id, user_3.id], 10), [user_3.id])
+
+    def test_phone_index(self):
+        """Should answer who has my phone and which contacts are registered by the reverse index."""
+        user_1 = save_user(mock_user_1)
+        user_2 = save_user(mock_user_2)
+        PhoneIndex.index_user(user_1)
+        PhoneIndex.index_user(user_2)
+
+        user_2.set_contact(["+8201022889311", "+821099999999"])
+
+        self.assertEqual(PhoneIndex.list_owner_ids_having(user_1.phone), {user_2.id})
+        self.assertEqual(PhoneIndex.list_owner_ids_having(user_1.phone, among=[user_1.id]), set())
+        self.assertEqual(PhoneIndex.list_user_ids_of(user_2.get_contact().phones), {user_1.id})
+
+        user_2.set_contact(["+821099999999"])
+        self.assertEqual(PhoneIndex.list_owner_ids_having(user_1.phone), set())
+
+    @mock.patch.object(auth, 'verify_id_token', return_value=dict(uid=mock_user_1["uid"]))
+    def test_sync_contacts(self, verify_id_token):
+        """Should apply only differences of phones at the same version."""
+        user = save_user(mock_user_1)
+        url = "/users/{user_id}/contacts".format(user_id=str(user.id))
+        headers = dict(uid=user.uid)
+
+        response = self.app.put(url, data=json.dumps(["+8201011112222", "+821033334444", "invalid"]),
+                                headers=headers, content_type="application/json")
+        self.assertEqual(response.get_json(), dict(version=1))
+
+        response = self.app.patch(url, data=json.dumps(dict(
+            version=1, added=["+821055556666"], removed=["+821033334444"])),
+                                  headers=headers, content_type="application/json")
+        self.assertEqual(response.get_json(), dict(version=2))
+        self.assertEqual(set(user.get_contact().phones), {"+821011112222", "+821055556666"})
+
+        response = self.app.patch(url, data=json.dumps(dict(version=1, added=["+821077778888"])),
+                                  headers=headers, content_type="application/json")
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.get_json(), dict(version=2))
+
+        # synced every time between reading the version and replacing.
+        stale = Contact(owner=user, phones=[], version=1)
+        with mock.patch.object(User, "get_contact", side_effect=[stale, stale, stale, user.get_contact()]):
+            response = self.app.put(url, data=json.dumps(["+821099999999"]),
+                                    headers=headers, content_type="application/json")
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(set(user.get_contact().phones), {"+821011112222", "+821055556666"})
+
+    def test_nightly_recommendation_batch(self):
+        """Should precompute the next day recommendations, resume from the checkpoint and serve them."""
+        user_1 = save_user(dict(mock_user_1, available=True))
+        user_2 = save_user(mock_user_2)
+        user_3 = save_user(dict(mock_user_3, uid="mock_user_4_uid", phone="+821022889314"))
+        checkpoint_path = os.path.join(tempfile.mkdtemp(), "checkpoint.json")
+
+        with mock.patch.object(User, "list_recommended_user_ids", return_value=[user_2.id, user_3.id]):
+            result = recommendation_batch.run(date="2020-05-22", checkpoint_path=checkpoint_path, echo=lambda x: x)
+            self.assertEqual(result["processed"], 1)
+            result = recommendation_batch.run(date="2020-05-22", checkpoint_path=checkpoint_path, echo=lambda x: x)
+            self.assertEqual(result["processed"], 1)
+
+        recommendation = Recommendation.objects.get(owner=user_1)
+        self.assertEqual(recommendation.next_user_ids, [user_2.id, user_3.id])
+
+        pendulum.set_test_now(pendulum.datetime(2020, 5, 22, 1, tz="Asia/Seoul"))
+        with mock.patch.object(User, "list_recommended_user_ids") as list_recommended_user_ids:
+            response = self.app.get("/users/{user_id}/recommendation".format(user_id=str(user_1.id)),
+                                    headers=dict(uid=user_1.uid))
+            list_recommended_user_ids.assert_not_called()
+        pendulum.set_test_now()
+
+        self.assertEqual([user["_id"] for user in response.get_json()], [str(user_2.id), str(user_3.id)])
+        self.assertEqual(Recommendation.objects.get(owner=user_1).next_user_ids, [])
+
+    def test_build_recommendation_pipeline(self):
+        """Should bound the geo query by the loosest band, then match the bands by the distance and limit."""
+        seoul = dict(coordinates=[127.0276, 37.4979], type="Point")
+        user = save_user(dict(mock_user_1, location=seoul))
+        nin_ids = {ObjectId()}
+        pipeline = user.build_recommendation_pipeline(nin_ids, limit=10, star_rating_avg=4)
+
+        geo_near = pipeline[0]["$geoNear"]
+        self.assertEqual(geo_near["near"]["coordinates"], seoul["coordinates"])
+        self.assertEqual(geo_near["maxDistance"], 240 * 1000)
+        self.assertNotIn("num", geo_near)
+        self.assertEqual(geo_near["query"]["_id"], {"$nin": list(nin_ids)})
+        self.assertAlmostEqual(geo_near["query"]["star_rating_avg"]["$gte"], 4 * 0.9 ** 3)
+
+        bands = pipeline[1]["$addFields"]["star_rating_min"]["$switch"]["branches"]
+        self.assertEqual([band["case"]["$lt"][1] for band in bands], [30000, 60000, 120000, 240000])
+        self.assertEqual([round(band["then"], 3) for band in bands], [4, 3.6, 3.24, 2.916])
+        self.assertEqual(pipeline[2], {"$match": {"$expr": {"$gte": ["$star_rating_avg", "$star_rating_min"]}}})
+        self.assertEqual(pipeline[3], {"$limit": 10})
+        self.assertEqual(set(pipeline[4]["$project"]), {"_id", "distance"} | set(scoring.FEATURE_FIELDS))
+
+    def test_score_candidates(self):
+        """Should rank nearer, similar aged, higher rated and recently logged in candidates first."""
+        pendulum.set_test_now(pendulum.datetime(2020, 5, 21, 12))
+        me = dict(birthed_at=mock_user_1["birthed_at"], interest_ids=[3, 6], charm_ids=[])
+        near = dict(_id=1, distance=1000, birthed_at=me["birthed_at"], star_rating_avg=4.5,
+                    last_login_at=pendulum.now().int_timestamp, interest_ids=[3, 6])
+        far = dict(near, _id=2, distance=100000)
+        low_rated = dict(near, _id=3, star_rating_avg=1)
+        candidates = [far, low_rated, near]
+
+        ranked = scoring.top_k(candidates, scoring.score(me, candidates), k=2)
+        pendulum.set_test_now()
+
+        self.assertEqual([candidate["_id"] for candidate in ranked], [1, 3])
+
+    @mock.patch.object(geo_index, "NAME", "blanc_geo_index_test_{0}".format(os.getpid()))
+    @mock.patch.object(geo_index, "LOCK_PATH", os.path.join(tempfile.gettempdir(), "blanc_geo_index_test.lock"))
+    def test_geo_index(self):
+        """Should list nearby users from the shared geo index, kept current with the feed of changes."""
+        seoul = dict(coordinates=[127.0276, 37.4979], type="Point")
+        busan = dict(coordinates=[129.0756, 35.1796], type="Point")
+        user_1 = save_user(dict(mock_user_1, location=seoul, available=True))
+        user_2 = save_user(dict(mock_user_2, location=seoul, available=True))
+        user_3 = save_user(dict(mock_user_2, uid="busan", location=busan, available=True))
+
+        try:
+            self.assertTrue(geo_index.refresh(User.list_geo_indexable, UserChange.list_since, UserChange.last_seq))
+            index = geo_index.get()
+            self.assertEqual(len(index), 3)
+
+            nearby = index.query(seoul["coordinates"], 5000, "F")
+            self.assertEqual([candidate["_id"] for candidate in nearby], [user_2.id])
+            everywhere = index.query(seoul["coordinates"], 400 * 1000, "F")
+            self.assertEqual([candidate["_id"] for candidate in everywhere], [user_2.id, user_3.id])
+
+            users = user_1.list_users_within_distance(distance=5)
+            self.assertEqual([user["_id"] for user in users], [user_2.id])
+
+            user_2.update(available=False)
+            user_2.publish_change()
+            self.assertTrue(geo_index.refresh(User.list_geo_indexable, UserChange.list_since, UserChange.last_seq))
+            self.assertFalse(geo_index.refresh(User.list_geo_indexable, UserChange.list_since, UserChange.last_seq))
+            self.assertEqual(len(geo_index.get()), 2)
+            self.assertEqual(user_1.list_users_within_distance(distance=5), [])
+
+            # a change written after the one of a greater seq is applied with the next.
+            late_seq = Sequence.next("user_change")
+            user_1.publish_change()
+            self.assertTrue(geo_index.refresh(User.list_geo_indexable, UserChange.list_since, UserChange.last_seq))
+            user_3.update(available=False)
+            UserChange(seq=late_seq, user_id=user_3.id, changed_at=pendulum.now()).save()
+            self.assertFalse(geo_index.refresh(User.list_geo_indexable, UserChange.list_since, UserChange.last_seq))
+            self.assertEqual(len(geo_index.get()), 2)
+            user_2.publish_change()
+            self.assertTrue(geo_index.refresh(User.list_geo_indexable, UserChange.list_since, UserChange.last_seq))
+            self.assertEqual(len(geo_index.get()), 1)
+        finally:
+            geo_index.unlink()
+
+    def test_presence(self):
+        """Should list online users of the opposite sex by the heartbeats, latest first."""
+        user_1 = save_user(dict(mock_user_1, available=True))
+        user_2 = save_user(dict(mock_user_2, available=True))
+        user_3 = save_user(dict(mock_user_2, uid="user_3", available=True))
+        user_4 = save_user(dict(mock_user_2, uid="user_4", available=False))
+        user_5 = save_user(dict(mock_user_2, uid="user_5", available=True))
+
+        now = pendulum.now()
+        pendulum.set_test_now(now.subtract(hours=1))
+        Presence.beat(user_5)
+        for seconds, user in enumerate([user_2, user_4, user_3]):
+            pendulum.set_test_now(now.add(seconds=seconds))
+            Presence.beat(user)
+        pendulum.set_test_now()
+
+        self.assertEqual(user_1.list_realtime_user_ids(), [user_3.id, user_2.id])
+        self.assertEqual(user_1.list_realtime_user_ids(size=1), [user_3.id])
+
+    def test_pick_users_not_knowing(self):
+        """Should hydrate users by chunks keeping the order, skipping the ones knowing each other."""
+        user_1 = save_user(mock_user_1)
+        user_2 = save_user(mock_user_2)
+        user_3 = save_user(mock_user_3)
+        user_4 = save_user(dict(mock_user_2, uid="user_4", phone="+821022889314"))
+        user_1.set_contact([user_3.phone])
+
+        users = user_1.pick_users_not_knowing([user_4.id, user_3.id, user_2.id], size=2, chunk_size=2)
+
+        self.assertEqual([user["_id"] for user in users], [user_4.id, user_2.id])
+        self.assertTrue(all("phone" not in user and "uid" not in user for user in users))
+        self.assertIn(user_3.id, user_1.get_contact().user_ids_know_me)
+
+    def test_sync_indexes(self):
+        """Should create the declared indexes and tell a collection scan in the winning plan."""
+        diff = index_service.sync(User)
+        self.assertIn([("uid", 1)], diff["missing"])
+        self.assertNotIn([("uid", 1)], index_service.sync(User)["missing"])
+
+        explain = {"queryPlanner": {
+            "winningPlan": {"stage": "LIMIT", "inputStage": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN"}}},
+            "rejectedPlans": [{"stage": "COLLSCAN"}]
+        }}
+        self.assertEqual(index_service.list_stages(explain), ["LIMIT", "FETCH", "IXSCAN"])
+
+    def test_session_relations(self):
+        """Should build the relations of the session, cached until a request or a rating is written."""
+        user_1 = save_user(mock_user_1)
+        user_2 = save_user(mock_user_2)
+        user_3 = save_user(mock_user_3)
+        Request(user_from=user_1, user_to=user_2, requested_at=1, response=1).save()
+        Request(user_from=user_3, user_to=user_1, requested_at=1).save()
+        StarRating(user_from=user_1, user_to=user_3, rated_at=1, score=4).save()
+
+        relations = session_service.get_relations(user_1)
+        self.assertEqual(relations["user_ids_matched"], [str(user_2.id)])
+        self.assertEqual(relations["user_ids_sent_me_request"], [str(user_3.id)])
+        self.assertEqual(relations["star_ratings_i_rated"], [dict(user_id=str(user_3.id), score=4)])
+        self.assertEqual(relations["point"], 0)
+
+        Request(user_from=user_1, user_to=user_3, requested_at=1, response=0).save()
+        self.assertEqual(session_service.get_relations(user_1)["user_ids_unmatched"], [])
+        session_service.invalidate(user_1)
+        self.assertEqual(session_service.get_relations(user_1)["user_ids_unmatched"], [str(user_3.id)])
+        session_service.invalidate(user_1)
+
+    def test_star_rating_aggregates(self):
+        """Should keep the rating aggregates incrementally, the same as the backfill from the ratings."""
+        user_1 = save_user(mock_user_1)
+        user_2 = save_user(mock_user_2)
+        for score in [5, 4, 5]:
+            StarRating(user_from=user_2, user_to=user_1, rated_at=1, score=score).save()
+            user_1.add_star_rating(score)
+
+        response = self.app.get("/users/{0}/score/distribution".format(user_1.id))
+        distribution = response.get_json()
+        self.assertEqual(distribution["count"], 3)
+        self.assertEqual(distribution["sum"], 14)
+        self.assertAlmostEqual(distribution["avg"], 14 / 3)
+        self.assertEqual(distribution["histogram"], {"1": 0, "2": 0, "3": 0, "4": 1, "5": 2})
+
+        User.objects(id=user_1.id).update_one(
+            set__star_rating_sum=0, set__star_rating_count=0, set__star_rating_histogram={})
+        self.assertEqual(User.backfill_star_ratings(), 1)
+        self.assertEqual(self.app.get("/users/{0}/score/distribution".format(user_1.id)).get_json(), distribution)
+
+    def test_user_loader(self):
+        """Should load the users of a request by a single query, not carried over to the next request."""
+        user_1 = save_user(mock_user_1)
+        user_2 = save_user(mock_user_2)
+        user_3 = save_user(mock_user_3)
+
+        with current_app.test_request_context():
+            with mock.patch.object(User, "list", wraps=User.list) as list_users:
+                User.loader().prime([user_1.id, user_2.id, user_3.id])
+                self.assertEqual(User.get(id=user_1.id).nickname, user_1.nickname)
+                users_dict = User.get_users_dict({user_2.id, str(user_3.id)})
+                self.assertEqual(set(users_dict.keys()), {str(user_2.id), str(user_3.id)})
+                self.assertNotIn("phone", users_dict[str(user_2.id)])
+                self.assertEqual(list_users.call_count, 1)
+
+                user_1.update(set__nickname="updated")
+                self.assertEqual(User.get(id=user_1.id).nickname, "updated")
+                self.assertEqual(list_users.call_count, 2)
+            current_app.do_teardown_request()
+            self.assertNotIn("user_loader", g)
+
+    def test_user_card_cache(self):
+        """Should serve the cards from the cache until the user is written."""
+        user_card_cache.clear()
+        user_1 = save_user(mock_user_1)
+        user_2 = save_user(mock_user_2)
+
+        cards = User.list_cards([user_1.id, str(user_2.id)])
+        self.assertEqual(cards[str(user_1.id)]["nickname"], user_1.nickname)
+        self.assertEqual(set(cards[str(user_2.id)].keys()),
+                         {"_id", "nickname", "image_url", "birthed_at", "sex", "area", "star_rating_avg"})
+        self.assertEqual(User.get_card(user_1.id)["nickname"], user_1.nickname)
+
+        user_1.update(set__nickname="updated")
+        self.assertEqual(User.get_card(user_1.id)["nickname"], "updated")
+        user_2.nickname = "saved"
+        user_2.save()
+        self.assertEqual(User.get_card(user_2.id)["nickname"], "saved")
+
+        stats = user_card_cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["invalidations"]), (1, 4, 2))
+        self.assertEqual(stats["hit_rate"], 0.2)
+
+    def test_withdraw_users(self):
+        """Should withdraw users one after another under the unique phone index."""
+        index_service.sync(User)
+        user_1 = save_user(mock_user_1)
+        user_2 = save_user(mock_user_2)
+        user_1.withdraw()
+        user_2.withdraw()
+        self.assertEqual(User.objects(phone=None).count(), 2)
+        self.assertEqual([spec for spec in User._meta["index_specs"] if spec["fields"][0][1] == "2dsphere"],
+                         [{"fields": [("location", "2dsphere"), ("sex", 1), ("birthed_at", 1)]}])
+
+
 if __name__ == "__main__":
     unittest.main()
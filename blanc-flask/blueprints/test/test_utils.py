@@ -25,6 +25,15 @@ def create_user(app, mock_user, sms_token):
     return response
 
 
+def save_user(mock_user):
+    """Saves a mock user directly, without going through the registration."""
+    params = mock_user.copy()
+    params.pop("user_images", None)
+    user = User(**params)
+    user.save()
+    return user
+
+
 def create_user_1(app):
     mock_user = mock_user_1.copy()
     return create_user(app, mock_user, user_1_sms_token)
@@ -18,9 +18,11 @@ from firebase_admin import messaging
 from firebase_admin import storage
 from firebase_admin import auth
 from firebase_admin._auth_utils import UserNotFoundError
-from model.models import Alarm, User, UserImage, Request, StarRating, Setting, Post, Contact
-from shared import regex
+from model.models import Alarm, User, UserImage, StarRating, Setting, Post, Contact, PhoneIndex, Presence
+from model.models import RECOMMENDATION_TIMEZONE
 from shared import message_service
+from shared import phone_service
+from shared import session_service
 from shared.annotation import id_token_required
 from shared.annotation import time_lapse
 from shared.hash_service import verify_sms_token
@@ -129,6 +131,7 @@ def route_update_user_location(user_id: str):
 
     coordinates = [float(longitude), float(latitude)]
     user.update(**dict(location=coordinates, area=area))
+    user.publish_change()
 
     response = json.dumps(dict(coordinates=coordinates, type="Point"))
     return Response(response, mimetype="application/json")
@@ -154,6 +157,7 @@ def route_update_user_profile(user_id: str):
         params[key] = value
 
     user.update(**params)
+    user.publish_change()
 
     return Response("", mimetype="application/json")
 
@@ -194,36 +198,10 @@ def route_get_session():
     """Endpoint for getting user session."""
     uid = request.headers.get("uid", None)
     user = User.objects.get_or_404(uid=uid)
-    user_id = user.id
 
-    point = user.get_current_amount_of_point()
+    relations = session_service.get_relations(user)
     user = user.to_mongo()
-
-    star_rating = StarRating.objects(user_from=user_id).as_pymongo()
-    received = Request.objects(user_to=user_id).as_pymongo()
-    sent = Request.objects(user_from=user_id).as_pymongo()
-
-    # 이미 성사 된 상대
-    matched_request_sent = [str(req["user_to"]) for req in sent if req.get("response") == 1]
-    matched_request_received = [str(req["user_from"]) for req in received if req.get("response") == 1]
-    user_ids_matched = matched_request_received + matched_request_sent
-    # 성사 되지 않은 상대
-    unmatched_request_sent = [str(req["user_to"]) for req in sent if req.get("response") == 0]
-    unmatched_request_received = [str(req["user_from"]) for req in received if req.get("response") == 0]
-    user_ids_unmatched = unmatched_request_sent + unmatched_request_received
-    # 이미 좋아요를 보냄
-    user_ids_i_sent_request = [str(req["user_to"]) for req in sent if req.get("response") != 1]
-    # 내게 좋아요를 보냄 and 미수락
-    user_ids_sent_me_request = [str(req["user_from"]) for req in received if req.get("response") != 1]
-    # 내가 평가 한 사람들
-    star_ratings_i_rated = [dict(user_id=str(x["user_to"]), score=x["score"]) for x in star_rating]
-
-    user["user_ids_matched"] = user_ids_matched
-    user["user_ids_unmatched"] = user_ids_unmatched
-    user["user_ids_i_sent_request"] = user_ids_i_sent_request
-    user["user_ids_sent_me_request"] = user_ids_sent_me_request
-    user["star_ratings_i_rated"] = star_ratings_i_rated
-    user["point"] = point
+    user.update(relations)
 
     response = encode(user)
     return Response(response, mimetype="application/json")
@@ -303,6 +281,7 @@ def route_update_user_status_to_approved(user_id: str):
     user.status = User.Status.APPROVED
     user.available = True
     user.save()
+    user.publish_change()
 
     data = dict(event=Alarm.Event.APPROVED)
     message_service.push(data, user)
@@ -319,6 +298,7 @@ def route_update_user_status_to_rejected(user_id: str):
     user.status = User.Status.REJECTED
     user.available = False
     user.save()
+    user.publish_change()
 
     response = encode(user.to_mongo())
     return Response(response, mimetype="application/json")
@@ -384,21 +364,27 @@ def route_list_users_recommendation(user_id: str):
 
     recommendation = user.get_recommendation()
 
+    today = pendulum.today(RECOMMENDATION_TIMEZONE).date()
     last_recommended_at = pendulum.from_timestamp(
-        recommendation.last_recommended_at, tz="Asia/Seoul")
-    is_today_recommended = last_recommended_at.date() == pendulum.today().date()
+        recommendation.last_recommended_at, tz=RECOMMENDATION_TIMEZONE)
+    is_today_recommended = last_recommended_at.date() == today
 
     if is_today_recommended and len(recommendation.user_ids) >= 2:
         user_ids = recommendation.user_ids
     else:
-        user_ids = user.list_recommended_user_ids()
+        # precomputed by the nightly batch, computes lazily when missed.
+        user_ids = user.list_next_recommended_user_ids(recommendation, str(today))
+        if len(user_ids) < 2:
+            user_ids = user.list_recommended_user_ids()
         user_ids.extend(recommendation.user_ids)
         recommendation.user_ids = user_ids
+        recommendation.next_user_ids = []
         recommendation.last_recommended_at = pendulum.now().int_timestamp
         recommendation.save()
+        user.exclude(*user_ids)
 
-    users = User.list(id__in=user_ids[:MAXIMUM_RECOMMENDATION_SHOW_COUNT]).as_pymongo()
-    users = sort_order_by_ids(user_ids, users)
+    user_ids = user_ids[:MAXIMUM_RECOMMENDATION_SHOW_COUNT]
+    users = sort_order_by_ids(user_ids, User.get_users_dict(user_ids).values())
     response = encode(list(users))
     return Response(response, mimetype="application/json")
 
@@ -411,7 +397,7 @@ def route_list_users_real_time(user_id: str):
     user.identify(request)
 
     user_ids = user.list_realtime_user_ids()
-    users = User.list(id__in=user_ids).as_pymongo()
+    users = sort_order_by_ids(user_ids, User.get_users_dict(user_ids).values())
     response = encode(list(users))
     return Response(response, mimetype="application/json")
 
@@ -428,9 +414,8 @@ def route_list_users_close(user_id: str, distance: int):
     if not user.location or not user.location["coordinates"]:
         return Response(json.dumps([]), mimetype="application/json")
 
-    close_user_ids = user.list_user_ids_within_distance(distance=distance)
-    users = User.list(id__in=close_user_ids).as_pymongo()
-    response = encode(list(users))
+    users = user.list_users_within_distance(distance=distance)
+    response = encode(users)
     return Response(response, mimetype="application/json")
 
 
@@ -451,27 +436,30 @@ def route_update_star_rating(user_id: str, score: int):
             rated_at=pendulum.now().int_timestamp,
             score=score
         ).save()
+        session_service.invalidate(user_from)
 
         if score > 3:
-            alarm = Alarm.create_alarm(
+            alarm_record = Alarm.create_alarm(
                 user_from=user_from,
                 user_to=user_to,
                 event=Alarm.Event.STAR_RATING,
                 message="{nickname} 님이 당신을 높게 평가 하였습니다.".format(nickname=user_from.nickname))
-            alarm_record = alarm.records[-1]
             data = alarm_record.as_dict()
             message_service.push(data, user_to)
 
-        star_ratings = StarRating.objects(user_to=user_to).all()
+        user_to.add_star_rating(score)
+        user_to.publish_change()
 
-        star_rating_sum = 0
-        for rating in star_ratings:
-            star_rating_sum += rating.score
-        star_rating_avg = star_rating_sum / len(star_ratings)
+    return Response("", mimetype="application/json")
 
-        user_to.update(star_rating_avg=star_rating_avg)
 
-    return Response("", mimetype="application/json")
+@users_blueprint.route("/users/<user_id>/score/distribution", methods=["GET"])
+def route_get_star_rating_distribution(user_id: str):
+    """Endpoint for getting the count of each score the user received."""
+    user = User.objects.only(
+        "star_rating_avg", "star_rating_sum", "star_rating_count", "star_rating_histogram").get_or_404(id=user_id)
+    response = encode(user.get_star_rating_distribution())
+    return Response(response, mimetype="application/json")
 
 
 @users_blueprint.route("/users/<user_id>/score", methods=["GET"])
@@ -491,23 +479,56 @@ def route_update_last_login_at(user_id: str):
     user.identify(request)
 
     user.update(last_login_at=pendulum.now().int_timestamp)
+    Presence.beat(user)
     return Response("", mimetype="application/json")
 
 
 @users_blueprint.route("/users/<user_id>/contacts", methods=["PUT"])
 @id_token_required
 def route_patch_user_contacts(user_id: str):
+    """Replaces all the phones of contacts, responds with the contact version."""
     user = User.objects.get_or_404(id=user_id)
     user.identify(request)
 
     phones = request.json
-    if not phones and phones is not list:
+    if not isinstance(phones, list):
         raise ValueError("phones must be list type.")
 
-    phones = [phone for phone in phones if re.match(regex.GLOBAL_PHONE_REGEX, phone)]
-    user.set_contact(phones)
+    phones = phone_service.normalize_all(phones)
+    contact = user.set_contact(phones)
 
-    return Response("", mimetype="application/json")
+    if contact is None:
+        response = json.dumps(dict(version=user.get_contact().version))
+        return Response(response, status=409, mimetype="application/json")
+
+    response = json.dumps(dict(version=contact.version))
+    return Response(response, mimetype="application/json")
+
+
+@users_blueprint.route("/users/<user_id>/contacts", methods=["PATCH"])
+@id_token_required
+def route_sync_user_contacts(user_id: str):
+    """Applies added and removed phones since the version.
+
+    Responds 409 with the current version when the contact has been changed since the version,
+    then the client is expected to upload all with PUT.
+    """
+    user = User.objects.get_or_404(id=user_id)
+    user.identify(request)
+
+    params: dict = request.get_json()
+    version = int(params.get("version", 0))
+    added = phone_service.normalize_all(params.get("added", []))
+    removed = phone_service.normalize_all(params.get("removed", []))
+
+    new_version = user.sync_contact(version, added_phones=added, removed_phones=removed)
+
+    if new_version is None:
+        response = json.dumps(dict(version=user.get_contact().version))
+        return Response(response, status=409, mimetype="application/json")
+
+    response = json.dumps(dict(version=new_version))
+    return Response(response, mimetype="application/json")
 
 
 @users_blueprint.route("/users/<user_id>/push/lookup", methods=["POST"])
@@ -535,13 +556,12 @@ def route_push_poke(user_id):
     user_from = User.get(uid=uid)
     user_to = User.get(id=user_id)
 
-    alarm = Alarm.create_alarm(
+    alarm_record = Alarm.create_alarm(
         event=Alarm.Event.POKE,
         user_from=user_from,
         user_to=user_to,
         message="{nickname} 님이 당신을 찔렀습니다.".format(nickname=user_from.nickname)
     )
-    alarm_record = alarm.records[-1]
     data: dict = alarm_record.as_dict()
     message_service.push(data, user_to)
 
@@ -602,6 +622,7 @@ def route_register_user():
                     available=False,
                     last_login_at=pendulum.now().int_timestamp)
         user.save()
+        PhoneIndex.index_user(user)
         alarm = Alarm(owner=user, records=[])
         alarm.save()
 
@@ -39,6 +39,9 @@ class Config(object):
     DEBUG_TB_INTERCEPT_REDIRECTS = False
     TESTMODE_YN = "Y"
     SECRET_KEY = "SECRET_KEY"
+    GEO_INDEX_ENABLED = True  # shared memory geo index of available users, see shared/geo_index.py
+    STREAM_HUB = "mongo"  # fan-out of conversation streams across workers, see shared/stream_hub.py
+    PUSH_DISPATCH = "outbox"  # pushes queued and sent by background threads, "inline" sends in the request
 
 
 class ProdConfig(Config):
@@ -78,3 +81,6 @@ class RemoteProdConfig(Config):
 class UnitTestConfig(Config):
     DEBUG = True
     TESTING = True
+    GEO_INDEX_ENABLED = False
+    STREAM_HUB = "local"
+    PUSH_DISPATCH = "inline"
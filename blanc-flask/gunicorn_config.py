@@ -1,6 +1,13 @@
 bind = "0.0.0.0:5000"
 workers = 5  # (2 x $num_cores) + 1
-threads = 2
+worker_class = "gthread"
+threads = 32  # each conversation stream holds a thread as long as it is open, up to STREAM_MAX_PER_WORKER
 timeout = 120
 
-# https://medium.com/@nhudinhtuan/gunicorn-worker-types-practice-advice-for-better-performance-7a299bb8f929
\ No newline at end of file
+# https://medium.com/@nhudinhtuan/gunicorn-worker-types-practice-advice-for-better-performance-7a299bb8f929
+
+
+def on_exit(server):
+    """Removes the shared memory of the geo index the workers built."""
+    from shared import geo_index
+    geo_index.unlink()
@@ -0,0 +1,197 @@
+"""Management commands. e.g. `OP_ENV=prod python manage.py phones index`"""
+
+import click
+import os
+
+from app import create_app
+from config import QaConfig, ProdConfig, DevConfig
+from model.models import User, Contact, PhoneIndex, Balance, Comment, Conversation, MessageBucket
+from shared import index_service
+from shared import recommendation_batch
+
+CONFIGS = dict(prod=ProdConfig, qa=QaConfig, dev=DevConfig)
+
+
+@click.group()
+@click.option("--env", default=lambda: os.environ.get("OP_ENV", "dev"), type=click.Choice(CONFIGS.keys()))
+@click.pass_context
+def cli(ctx, env):
+    ctx.obj = CONFIGS[env]
+    app = create_app(config=ctx.obj, firebase=False)
+    app.app_context().push()
+
+
+@cli.group()
+def phones():
+    """Reverse phone index of contacts."""
+
+
+@phones.command("index")
+def index_phones():
+    """Builds the reverse phone index from all the users and contacts."""
+    users = User.objects(phone__ne=None).only("id", "phone")
+    for count, user in enumerate(users, start=1):
+        PhoneIndex.index_user(user)
+        if count % 1000 == 0:
+            click.echo("indexed {0} users..".format(count))
+
+    contacts = Contact.objects.only("owner", "phones").as_pymongo()
+    for count, contact in enumerate(contacts, start=1):
+        PhoneIndex.index_owner(contact["owner"], added_phones=contact.get("phones", []))
+        if count % 1000 == 0:
+            click.echo("indexed {0} contacts..".format(count))
+
+    click.echo("done.")
+
+
+@cli.group()
+def indexes():
+    """Indexes declared in the meta of documents."""
+
+
+@indexes.command("sync")
+@click.option("--drop", is_flag=True, help="Drops the indexes not declared as well.")
+@click.option("--dry-run", is_flag=True, help="Only prints the difference.")
+def sync_indexes(drop, dry_run):
+    """Creates the declared indexes in the background."""
+    for document in index_service.list_documents():
+        diff = document.compare_indexes() if dry_run else index_service.sync(document, drop=drop)
+        for index in diff["missing"]:
+            click.echo("{0}: + {1}".format(document.__name__, index))
+        for index in diff["extra"]:
+            click.echo("{0}: {1} {2}".format(document.__name__, "-" if drop else "?", index))
+    click.echo("done.")
+
+
+@indexes.command("explain")
+@click.option("--user-id", default=None, help="User to run the queries on behalf of, any available one by default.")
+def explain_indexes(user_id):
+    """Explains the hot queries, failing if any of them scans the whole collection."""
+    params = dict(id=user_id) if user_id else dict(available=True, location__exists=True)
+    user = User.objects(**params).first()
+    if not user:
+        raise click.ClickException("no user to run the queries on behalf of.")
+
+    failed = []
+    for name, explain in index_service.list_hot_queries(user):
+        stages = index_service.list_stages(explain())
+        click.echo("{0}: {1}".format(name, " <- ".join(stages)))
+        if "COLLSCAN" in stages:
+            failed.append(name)
+
+    if failed:
+        raise click.ClickException("COLLSCAN in {0}".format(", ".join(failed)))
+    click.echo("done.")
+
+
+@cli.group()
+def points():
+    """Point balances materialized from the payments."""
+
+
+@points.command("reconcile")
+@click.option("--fix", is_flag=True, help="Overwrites the mismatched balances with the ledger.")
+def reconcile_points(fix):
+    """Verifies the balances against the payments as the ledger."""
+    mismatches = Balance.list_mismatches()
+    for owner_id, balance, amount in mismatches:
+        click.echo("{0}: balance {1}, ledger {2}".format(owner_id, balance, amount))
+        if fix:
+            Balance.objects(owner=owner_id, balance=balance).update_one(set__balance=amount)
+
+    if mismatches and not fix:
+        raise click.ClickException("{0} balances mismatched.".format(len(mismatches)))
+    click.echo("done.")
+
+
+@cli.group()
+def star_ratings():
+    """Rating aggregates of users."""
+
+
+@star_ratings.command("backfill")
+def backfill_star_ratings():
+    """Initializes the sum, the count and the histogram of the ratings of all the rated users."""
+    count = User.backfill_star_ratings()
+    click.echo("done. {0} users backfilled.".format(count))
+
+
+@cli.group()
+def comments():
+    """Comments of posts."""
+
+
+@comments.command("migrate")
+def migrate_comments():
+    """Sets the parent of the replies, which used to be only in the child ids of the parents."""
+    parents = Comment.objects(comments__not__size=0).only("id", "comments").as_pymongo()
+    for count, parent in enumerate(parents, start=1):
+        Comment.objects(id__in=parent["comments"]).update(set__parent_id=parent["_id"])
+        if count % 1000 == 0:
+            click.echo("migrated replies of {0} comments..".format(count))
+    click.echo("done.")
+
+
+@cli.group()
+def messages():
+    """Messages of conversations."""
+
+
+@messages.command("migrate")
+def migrate_messages():
+    """Moves the messages embedded in conversations into the buckets, then fills the summaries of the list."""
+    collection = Conversation._get_collection()
+    conversations = Conversation.objects(messages__not__size=0).only("id", "messages").as_pymongo()
+    for count, conversation in enumerate(conversations, start=1):
+        embedded = sorted(conversation.get("messages") or [], key=lambda message: message["id"])
+        if embedded:
+            # skips the ones moved by an interrupted run, whose last bucket may have been appended to since.
+            migrated = set(MessageBucket._get_collection().distinct(
+                "messages.id", {"conversation_id": conversation["_id"], "first_id": {"$lte": embedded[-1]["id"]}}))
+            MessageBucket.insert_messages(
+                conversation["_id"], [message for message in embedded if message["id"] not in migrated])
+            # unless a newer one has been added since deployed.
+            collection.update_one(
+                {"_id": conversation["_id"], "last_message": None}, {"$set": {"last_message": embedded[-1]}})
+            collection.update_one(
+                {"_id": conversation["_id"]}, {"$max": {"last_activity_at": embedded[-1]["created_at"]}})
+        collection.update_one({"_id": conversation["_id"]}, {"$unset": {"messages": ""}})
+        if count % 1000 == 0:
+            click.echo("migrated messages of {0} conversations..".format(count))
+
+    for conversation in Conversation.objects(last_activity_at=None).only("id", "created_at").as_pymongo():
+        collection.update_one({"_id": conversation["_id"]}, {"$set": {"last_activity_at": conversation["created_at"]}})
+
+    # left by the conversations deleted by queries before the buckets cascaded.
+    buckets = MessageBucket._get_collection()
+    conversation_ids = buckets.distinct("conversation_id")
+    orphan_ids = set(conversation_ids) - set(collection.distinct("_id", {"_id": {"$in": conversation_ids}}))
+    if orphan_ids:
+        buckets.delete_many({"conversation_id": {"$in": list(orphan_ids)}})
+        click.echo("removed buckets of {0} deleted conversations..".format(len(orphan_ids)))
+    click.echo("done.")
+
+
+@cli.group()
+def recommendations():
+    """Daily recommendations."""
+
+
+@recommendations.command("generate")
+@click.option("--date", default=None, help="Date to precompute, tomorrow in Asia/Seoul by default.")
+@click.option("--chunk-size", default=500, show_default=True)
+@click.option("--processes", default=os.cpu_count(), show_default=True, help="0 runs in this process.")
+@click.option("--checkpoint", default=None, help="File to resume from, recommendations_<date>.json by default.")
+@click.pass_obj
+def generate_recommendations(config, date, chunk_size, processes, checkpoint):
+    """Precomputes the next day recommendations of all available users."""
+    date = date or recommendation_batch.next_date()
+    checkpoint = checkpoint or "recommendations_{date}.json".format(date=date)
+    result = recommendation_batch.run(
+        date=date, config=config, chunk_size=chunk_size, processes=processes,
+        checkpoint_path=checkpoint, echo=click.echo)
+    click.echo("done. {processed} users processed, {failed} failed.".format(**result))
+
+
+if __name__ == "__main__":
+    cli()
@@ -1,22 +1,66 @@
 # coding: utf-8
 
 import hashlib
+import itertools
 import flask_mongoengine as fm
+import numpy as np
 import pendulum
-import random
 import mongoengine as db
 
 from bson.objectid import ObjectId
+from mongoengine import signals
+from pymongo import ReturnDocument
+from pymongo import UpdateOne
 from flask import abort
 from flask import current_app as app
 from shared.annotation import time_lapse
 from shared.hash_service import sha256
+from shared import geo_index
+from shared import phone_service
+from shared import scoring
+from shared import user_card_cache
+from shared import user_loader
 
 ONE_YEAR_TO_SECONDS = 31556926
 
 FREE_PASS_NEXT = 12
 FREE_OPEN_NEXT = 24 * 3
 
+# Days of recommendations roll over in this timezone.
+RECOMMENDATION_TIMEZONE = "Asia/Seoul"
+# Distance bands (km) of a recommendation, the star rating threshold decays by each band.
+RECOMMENDATION_DIAMETERS = [30, 60, 120, 240]
+RECOMMENDATION_RATING_DECAY = 0.9
+# Candidates fetched per a user to show, to make up the ones knowing each other.
+CANDIDATE_OVERFETCH = 5
+# Nearest candidates to score for a recommendation.
+RECOMMENDATION_CANDIDATE_POOL = 200
+STAR_RATING_SCORES = [1, 2, 3, 4, 5]
+# top level comments of a post listed at once, the rest are loaded by the cursor.
+COMMENTS_PER_POST = 20
+# users are online for 30 minutes since the last heartbeat.
+PRESENCE_TTL = 60 * 30
+
+# messages of a conversation are stored in buckets of this many.
+MESSAGES_PER_BUCKET = 200
+MESSAGES_PER_PAGE = 30
+
+# streams beat every 15 seconds, so subscriptions not refreshed for a minute are gone.
+STREAM_SUBSCRIPTION_TTL = 60
+# events fanned out to the workers are kept in a capped collection only shortly.
+STREAM_EVENTS_MAX_DOCUMENTS = 10000
+STREAM_EVENTS_MAX_SIZE = 16 * 1024 * 1024
+
+# pushes sent or given up are kept for a day to look into.
+PUSH_OUTBOX_TTL = 60 * 60 * 24
+
+# records kept in the inbox of a user, newest first.
+ALARM_RECORDS_LIMIT = 200
+# marking read up to a timestamp is retried when records are pushed meanwhile.
+ALARM_MARK_READ_ATTEMPTS = 3
+# replacing the phones of a contact is retried when it is synced meanwhile.
+CONTACT_SET_ATTEMPTS = 3
+
 # Set any default index options - see the full options list
 INDEX_OPTS = {}
 # Set the default value for if an index should be indexed in the background
@@ -26,6 +70,7 @@ INDEX_CLS = False
 # When this is True (default), MongoEngine will ensure that the correct indexes exist in MongoDB
 # each time a command is run. This can be disabled in systems where indexes are managed separately.
 # Disabling this will improve performance.
+# The indexes declared in meta are managed by `manage.py indexes sync` instead.
 AUTO_CREATE_INDEX = False
 
 
@@ -40,14 +85,6 @@ def _get_hash(user_id: str):
     return hash_today + user_own_hash
 
 
-def _get_index_at(cursor, index):
-    try:
-        result = cursor[index]
-        return result
-    except IndexError as e:
-        return None
-
-
 class UserImage(db.EmbeddedDocument):
     index = db.IntField()
     url = db.StringField()
@@ -62,11 +99,13 @@ class User(db.Document):
         'index_cls': INDEX_CLS,
         'auto_create_index': AUTO_CREATE_INDEX,
         'indexes': [
-            # 'uid',
-            # 'phone',
-            # '-last_login_at',
-            # (("location", "2dsphere"), '-birthed_at'),
-            # (("location", "2dsphere"), '-birthed_at', '-star_rating_avg'),
+            'uid',
+            # withdrawn users have no phone.
+            {'fields': ['phone'], 'unique': True, 'sparse': True},
+            'status',
+            '-last_login_at',
+            ('available', 'id'),
+            ('(location', 'sex', 'birthed_at'),  # 2dsphere
         ]
     }
 
@@ -91,13 +130,14 @@ class User(db.Document):
     smoking_id = db.IntField()
     blood_id = db.IntField()
     device_token = db.StringField()
-    location = db.PointField()
+    # indexed along with the sex and birthed_at in meta, $geoNear fails when there are two 2dsphere indexes.
+    location = db.PointField(auto_index=False)
     introduction = db.StringField()
     joined_at = db.LongField()
     last_login_at = db.LongField()
     job = db.StringField()
     area = db.StringField()
-    phone = db.StringField(unique=True)
+    phone = db.StringField()
 
     user_images = db.SortedListField(db.EmbeddedDocumentField(UserImage), ordering="index")
     user_images_temp = db.SortedListField(db.EmbeddedDocumentField(UserImage), ordering="index")
@@ -115,7 +155,10 @@ class User(db.Document):
         Status.BLOCKED,
         Status.UNREGISTERED
     ])
-    star_rating_avg = db.FloatField(default=0)
+    star_rating_avg = db.FloatField(default=0)  # derived from the sum and the count below
+    star_rating_sum = db.IntField(default=0)
+    star_rating_count = db.IntField(default=0)
+    star_rating_histogram = db.DictField()  # count of each score e.g. {"5": 10}
 
     free_pass_tokens = db.ListField(db.LongField(), default=[0, 0])
     free_open_tokens = db.ListField(db.LongField(), default=[0])
@@ -146,7 +189,7 @@ class User(db.Document):
         score_repository = {
             str(s.get("user_from")): dict(score=s.get("score", 0), rated_at=s.get("rated_at")) for s in star_ratings
         }
-        raters = User.list(id__in=score_repository.keys()).as_pymongo()
+        raters = User.get_users_dict(score_repository.keys()).values()
 
         result = []
         for rater in raters:
@@ -181,6 +224,20 @@ class User(db.Document):
             recommendation.reload()
         return recommendation
 
+    def prepare_next_recommendation(self, date: str):
+        """Precomputes recommended users of the date, which the nightly batch does for the next day."""
+        recommendation = self.get_recommendation()
+        user_ids = self.list_recommended_user_ids()
+        recommendation.update(set__next_user_ids=user_ids, set__next_recommended_for=date)
+        return user_ids
+
+    def list_next_recommended_user_ids(self, recommendation, date: str) -> list:
+        """Lists precomputed recommended users of the date, dropping ones excluded since precomputed."""
+        if recommendation.next_recommended_for != date:
+            return []
+        nin_ids = self._get_nin_ids()
+        return [user_id for user_id in recommendation.next_user_ids if user_id not in nin_ids]
+
     def get_first_image(self):
         return self.user_images[0].url if self.user_images else ""
 
@@ -196,12 +253,51 @@ class User(db.Document):
                 break
         recommendation.save()
 
+    def add_star_rating(self, score: int) -> float:
+        """Adds a score into the rating aggregates atomically, then derives the average from them."""
+        params = {"inc__star_rating_histogram__{0}".format(score): 1}
+        user = User.objects(id=self.id).modify(
+            inc__star_rating_sum=score, inc__star_rating_count=1, new=True, **params)
+        star_rating_avg = user.star_rating_sum / user.star_rating_count
+        # skipped when a newer rating has been added meanwhile, which sets its own.
+        User.objects(id=self.id, star_rating_count=user.star_rating_count).update_one(
+            set__star_rating_avg=star_rating_avg)
+        user_card_cache.invalidate(self.id)
+        return star_rating_avg
+
+    def get_star_rating_distribution(self) -> dict:
+        histogram = {str(score): 0 for score in STAR_RATING_SCORES}
+        histogram.update(self.star_rating_histogram or {})
+        return dict(
+            avg=self.star_rating_avg,
+            sum=self.star_rating_sum,
+            count=self.star_rating_count,
+            histogram=histogram)
+
+    @classmethod
+    def backfill_star_ratings(cls) -> int:
+        """Initializes the rating aggregates of all the rated users from the ratings, returns the count of them."""
+        pipeline = [{"$group": {"_id": {"user_to": "$user_to", "score": "$score"}, "count": {"$sum": 1}}}]
+        aggregates = {}
+        for group in StarRating.objects.aggregate(pipeline):
+            user_id, score = group["_id"]["user_to"], group["_id"]["score"]
+            aggregate = aggregates.setdefault(user_id, dict(sum=0, count=0, histogram={}))
+            aggregate["sum"] += score * group["count"]
+            aggregate["count"] += group["count"]
+            aggregate["histogram"][str(score)] = group["count"]
+
+        operations = [UpdateOne({"_id": user_id}, {"$set": {
+            "star_rating_sum": aggregate["sum"],
+            "star_rating_count": aggregate["count"],
+            "star_rating_histogram": aggregate["histogram"],
+            "star_rating_avg": aggregate["sum"] / aggregate["count"]
+        }}) for user_id, aggregate in aggregates.items()]
+        if operations:
+            User._get_collection().bulk_write(operations, ordered=False)
+        return len(operations)
+
     def get_current_amount_of_point(self):
-        payments = Payment.objects(owner=self).all()
-        amount_sum = 0
-        for payment in payments:
-            amount_sum += payment.amount
-        return amount_sum
+        return Balance.get_balance(self)
 
     def is_available_for_free_pass_token(self):
         token_min = min(self.free_pass_tokens)
@@ -235,12 +331,12 @@ class User(db.Document):
         if amount <= 0:
             raise ValueError("Illegal amount found. The amount must be bigger than 0.")
 
-        total_amount = self.get_current_amount_of_point()
-        if total_amount < amount:
+        remaining = Balance.withdraw(self, amount)
+        if remaining is None:
             raise Exception(
                 "Not enough balance..\n"
                 "remaining amount: {total_amount}, amount to consume: {amount}".format(
-                    total_amount=total_amount, amount=amount))
+                    total_amount=self.get_current_amount_of_point(), amount=amount))
 
         Payment(
             owner=self,
@@ -274,7 +370,9 @@ class User(db.Document):
             created_at=int(created_at),
             purchase_time_ms=int(purchase_time_ms)
         )
+        Balance.get_balance(self)  # initializes the balance before the ledger changes.
         payment.save()
+        Balance.deposit(self, amount)
 
         return Payment.Result.PURCHASED
 
@@ -286,12 +384,64 @@ class User(db.Document):
             return list(payments)
 
     def set_contact(self, phones):
-        contact = self.get_contact()
-        contact.phones = phones
-        contact.last_updated = pendulum.now().int_timestamp
-        contact.save()
-        contact.reload()
-        return contact
+        """Replaces the phones of the contact, returns the contact or None when it keeps being synced meanwhile."""
+        for _ in range(CONTACT_SET_ATTEMPTS):
+            version = self.get_contact().version
+            # the one replaced, to index the difference from.
+            previous = Contact.at_version(self, version).modify(
+                set__phones=phones,
+                inc__version=1,
+                set__last_updated_at=pendulum.now().int_timestamp,
+                new=False)
+            if previous is not None:
+                break
+        else:
+            return None
+
+        PhoneIndex.index_owner(
+            self.id,
+            added_phones=set(phones) - set(previous.phones),
+            removed_phones=set(previous.phones) - set(phones))
+        # phones removed from contacts must not be excluded anymore.
+        self.reset_exclusion()
+        self.is_phones_cached = False
+        return Contact.objects(owner=self).first()
+
+    def sync_contact(self, version, added_phones=None, removed_phones=None):
+        """Applies added and removed phones to the contact at `version`.
+
+        Returns the new version, or None when the contact has been changed since `version`.
+        """
+        removed_phones = list(set(removed_phones or []))
+        added_phones = list(set(added_phones or []) - set(removed_phones))
+
+        updated = Contact.at_version(self, version).update_one(
+            add_to_set__phones=added_phones,
+            inc__version=1,
+            set__last_updated_at=pendulum.now().int_timestamp)
+
+        if not updated:
+            if version or Contact.objects(owner=self).first():
+                return None
+            Contact(owner=self, phones=added_phones, version=1,
+                    last_updated_at=pendulum.now().int_timestamp).save()
+        # a field can not be added to and pulled from by a single update, so the version bumped above guards this.
+        if removed_phones and updated and \
+                not Contact.objects(owner=self, version=version + 1).update_one(pull_all__phones=removed_phones):
+            # the added ones are stored already, so the full upload following the conflict does not see them as new.
+            PhoneIndex.index_owner(self.id, added_phones=added_phones)
+            self.exclude(*PhoneIndex.list_user_ids_of(added_phones))
+            self.is_phones_cached = False
+            return None
+
+        PhoneIndex.index_owner(self.id, added_phones=added_phones, removed_phones=removed_phones)
+        if removed_phones:
+            self.reset_exclusion()
+        else:
+            self.exclude(*PhoneIndex.list_user_ids_of(added_phones))
+
+        self.is_phones_cached = False
+        return version + 1
 
     def add_user_knows_me(self, user):
         contact = self.get_contact()
@@ -299,6 +449,7 @@ class User(db.Document):
         if user.id not in user_ids_know_me:
             contact.user_ids_know_me.append(user.id)
             contact.save()
+        self.exclude(user)
 
     def get_contact(self):
         contact = Contact.objects(owner=self).first()
@@ -332,7 +483,106 @@ class User(db.Document):
             return True
         return False
 
+    def list_user_ids_know_each_other(self, user_ids) -> set:
+        """Resolves the users knowing each other with me among `user_ids` and records it on both sides."""
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+
+        known_ids = set()
+        phones = self.get_phones()
+        if phones:  # checks whether I know them
+            known_ids.update(User.list_only_user_ids(id__in=user_ids, phone__in=phones))
+        if self.phone:  # checks whether they know me
+            known_ids.update(PhoneIndex.list_owner_ids_having(self.phone, among=user_ids))
+
+        if known_ids:
+            self.add_users_know_each_other(known_ids)
+        return known_ids
+
+    def add_users_know_each_other(self, user_ids):
+        """Records knows-me links of both sides with a single bulk write."""
+        user_ids = list(user_ids)
+        set_on_insert = {"phones": [], "last_updated_at": pendulum.now().int_timestamp}
+        operations = [UpdateOne(
+            {"owner": self.id},
+            {"$addToSet": {"user_ids_know_me": {"$each": user_ids}}, "$setOnInsert": set_on_insert},
+            upsert=True)]
+        operations.extend(UpdateOne(
+            {"owner": user_id},
+            {"$addToSet": {"user_ids_know_me": self.id}, "$setOnInsert": set_on_insert},
+            upsert=True) for user_id in user_ids)
+        Contact._get_collection().bulk_write(operations, ordered=False)
+
+        self.exclude(*user_ids)
+        Exclusion.objects(owner__in=user_ids).update(add_to_set__user_ids=self.id)
+
+    def pick_user_ids_not_knowing(self, user_ids, size, chunk_size=None):
+        """Picks up to `size` ids keeping the order, checking knowing each other by chunks."""
+        chunk_size = chunk_size or size * CANDIDATE_OVERFETCH
+        result = []
+        for index in range(0, len(user_ids), chunk_size):
+            chunk = user_ids[index:index + chunk_size]
+            known_ids = self.list_user_ids_know_each_other(chunk)
+            result.extend(user_id for user_id in chunk if user_id not in known_ids)
+            if len(result) >= size:
+                break
+        return result[:size]
+
+    def pick_users_not_knowing(self, user_ids, size, chunk_size=None) -> list:
+        """Picks up to `size` users with the list projection keeping the order, hydrating by chunks.
+
+        Knowing each other is resolved with the phones hydrated together, so each chunk is a single `$in` query.
+        """
+        chunk_size = chunk_size or size * CANDIDATE_OVERFETCH
+        phones = set(self.get_phones())
+        owner_ids_having_me = PhoneIndex.list_owner_ids_having(self.phone) if self.phone else set()
+        excludes = [field for field in User.excludes() if field != "phone"]
+
+        result = []
+        for index in range(0, len(user_ids), chunk_size):
+            chunk = user_ids[index:index + chunk_size]
+            users = {user["_id"]: user for user in User.objects(id__in=chunk).exclude(*excludes).as_pymongo()}
+            known_ids = {user_id for user_id, user in users.items()
+                         if user.get("phone") in phones or user_id in owner_ids_having_me}
+            if known_ids:
+                self.add_users_know_each_other(known_ids)
+            for user_id in chunk:
+                if user_id in users and user_id not in known_ids:
+                    users[user_id].pop("phone", None)
+                    result.append(users[user_id])
+            if len(result) >= size:
+                break
+        return result[:size]
+
     def _get_nin_ids(self) -> set:
+        """Returns the persisted nin ids, building it at the first time."""
+        exclusion = Exclusion.objects(owner=self).only("user_ids").as_pymongo().first()
+        if exclusion is not None:
+            return set(exclusion.get("user_ids", []))
+
+        nin_ids = self._collect_nin_ids()
+        try:
+            Exclusion(owner=self, user_ids=list(nin_ids), updated_at=pendulum.now().int_timestamp).save()
+        except db.NotUniqueError:
+            # built concurrently by another request.
+            self.exclude(*nin_ids)
+        return nin_ids
+
+    def exclude(self, *user_ids):
+        """Adds user ids into the persisted nin ids if it has been built already."""
+        user_ids = [user_id.id if isinstance(user_id, User) else user_id for user_id in user_ids]
+        if not user_ids:
+            return
+        Exclusion.objects(owner=self).update_one(
+            add_to_set__user_ids=user_ids, set__updated_at=pendulum.now().int_timestamp)
+
+    def reset_exclusion(self):
+        """Drops the persisted nin ids so that it is rebuilt on the next read."""
+        Exclusion.objects(owner=self).delete()
+
+    def _collect_nin_ids(self) -> set:
+        """Rebuilds nin ids from requests, recommendation and contact."""
 
         app.logger.debug("collecting nin ids..")
         nin_ids = set()
@@ -358,101 +608,141 @@ class User(db.Document):
         contact = self.get_contact()
         know_ids = [user_id for user_id in contact.user_ids_know_me]
         nin_ids.update(know_ids)
-        phones = contact.phones
-        ids_in_contacts = User.list_only_user_ids(phone__in=phones)
+        ids_in_contacts = PhoneIndex.list_user_ids_of(contact.phones)
         nin_ids.update(ids_in_contacts)
 
         app.logger.debug("collected nin ids with contacts phone numbers..")
 
         return nin_ids
 
-    def list_recommended_user_ids(self, nin_ids: set = None, result=None,
-                                  min_diameter=0, max_diameter=30,
-                                  star_rating_avg=3.5):
-        """Generates recommended users. If not found, recursively try it increasing diameter up to 300 km."""
-        sex = next((s for s in ['M', 'F'] if s != self.sex))
-        result = result or []
-        nin_ids = nin_ids or self._get_nin_ids()
+    def list_recommendation_candidates(self, nin_ids: set = None, limit=RECOMMENDATION_CANDIDATE_POOL,
+                                       star_rating_avg=3.5):
+        """Lists recommendation candidates with scoring features by distance in a single `$geoNear` round-trip.
 
+        The minimum `star_rating_avg` decays by 10% for each doubled distance band (30, 60, 120, 240 km)
+        which used to be done by re-querying recursively with a doubled diameter.
+        """
+        sex = next((s for s in ['M', 'F'] if s != self.sex))
+        nin_ids = nin_ids if nin_ids is not None else self._get_nin_ids()
+
+        index = geo_index.get()
+        if index is not None:
+            location = self.location["coordinates"] if self.location else [127.0977517240413, 37.49880740259655]
+            diameters = np.array(RECOMMENDATION_DIAMETERS) * 1000
+            candidates = index.query(
+                location, RECOMMENDATION_DIAMETERS[-1] * 1000, sex,
+                birthed_at_gte=self.birthed_at - (12 * ONE_YEAR_TO_SECONDS),
+                birthed_at_lte=self.birthed_at + (12 * ONE_YEAR_TO_SECONDS),
+                star_rating_min=lambda distance: star_rating_avg * (
+                        RECOMMENDATION_RATING_DECAY ** np.searchsorted(diameters, distance, side="right")),
+                nin_ids=nin_ids,
+                limit=limit)
+            return User._hydrate_geo_candidates(candidates, sex)
+
+        pipeline = self.build_recommendation_pipeline(nin_ids, limit=limit, star_rating_avg=star_rating_avg)
+
+        app.logger.debug("collecting recommendation candidates with query: {0}..".format(str(pipeline[0])))
+
+        return list(User.objects.aggregate(pipeline))
+
+    def build_recommendation_pipeline(self, nin_ids: set, limit=RECOMMENDATION_CANDIDATE_POOL,
+                                      star_rating_avg=3.5) -> list:
+        sex = next((s for s in ['M', 'F'] if s != self.sex))
         location = self.location["coordinates"] if self.location else [127.0977517240413, 37.49880740259655]
-        params = dict(
-            location__near=location,
-            location__min_distance=min_diameter * 1000,
-            location__max_distance=max_diameter * 1000,
-            birthed_at__gte=self.birthed_at - (12 * ONE_YEAR_TO_SECONDS),
-            birthed_at__lte=self.birthed_at + (12 * ONE_YEAR_TO_SECONDS),
-            star_rating_avg__gte=star_rating_avg,
-            id__nin=nin_ids,
-            available=True,
-            sex=sex
-        )
-
-        if max_diameter > 300:
-            return result
-
-        app.logger.debug("collecting users with params: {0}..".format(str(params)))
-
-        cursor = User.list(**params)
-
-        index = 0
-        while True:
-            app.logger.debug("cursor is moving..")
-            user = _get_index_at(cursor, index)
-
-            if user is None:
-                break
+        query = {
+            "_id": {"$nin": list(nin_ids)},
+            "birthed_at": {
+                "$gte": self.birthed_at - (12 * ONE_YEAR_TO_SECONDS),
+                "$lte": self.birthed_at + (12 * ONE_YEAR_TO_SECONDS)
+            },
+            "available": True,
+            "sex": sex,
+            # the loosest of the bands, the rest is matched by the distance after.
+            "star_rating_avg": {
+                "$gte": star_rating_avg * (RECOMMENDATION_RATING_DECAY ** (len(RECOMMENDATION_DIAMETERS) - 1))
+            }
+        }
+        star_rating_bands = [
+            {"case": {"$lt": ["$distance", max_diameter * 1000]},
+             "then": star_rating_avg * (RECOMMENDATION_RATING_DECAY ** index)}
+            for index, max_diameter in enumerate(RECOMMENDATION_DIAMETERS)
+        ]
+        return [
+            {"$geoNear": {
+                "near": {"type": "Point", "coordinates": location},
+                "key": "location",
+                "distanceField": "distance",
+                "maxDistance": RECOMMENDATION_DIAMETERS[-1] * 1000,
+                "spherical": True,
+                # uncapped since MongoDB 4.2, which rejects `num`, so the bands are matched and limited after.
+                "query": query
+            }},
+            {"$addFields": {"star_rating_min": {"$switch": {"branches": star_rating_bands, "default": 0}}}},
+            {"$match": {"$expr": {"$gte": ["$star_rating_avg", "$star_rating_min"]}}},
+            {"$limit": limit},
+            {"$project": dict({"_id": 1, "distance": 1}, **{field: 1 for field in scoring.FEATURE_FIELDS})}
+        ]
 
-            if self.does_know_each_other(user):
-                self.add_user_knows_me(user)
-                user.add_user_knows_me(self)
-                nin_ids.add(user.id)
-                continue
-            result.append(user.id)
-            index += 1
-            if len(result) >= 2:
-                break
+    def list_recommended_user_ids(self, nin_ids: set = None, size=2, star_rating_avg=3.5):
+        """Generates recommended users within 240 km ranked by the score, skipping the ones knowing each other."""
+        nin_ids = nin_ids if nin_ids is not None else self._get_nin_ids()
 
-        if len(result) < 2:
-            app.logger.debug("Not enough recommended user found.. collecting more")
-            return self.list_recommended_user_ids(
-                nin_ids, result=result, star_rating_avg=star_rating_avg * 0.9,
-                min_diameter=max_diameter, max_diameter=max_diameter * 2)
+        candidates = self.list_recommendation_candidates(nin_ids=nin_ids, star_rating_avg=star_rating_avg)
+        candidates = scoring.top_k(candidates, scoring.score(self.to_mongo(), candidates))
+        candidate_ids = [candidate["_id"] for candidate in candidates]
 
-        return result  # 126.98265075683594, 37.56100082397461
+        return self.pick_user_ids_not_knowing(candidate_ids, size)
 
-    def list_realtime_user_ids(self):
+    def list_realtime_user_ids(self, size=10):
+        """Lists users online in the last 30 minutes, reading the presence index only as far as needed."""
         nin_ids = self._get_nin_ids()
         sex = 'M' if self.sex == 'F' else 'F'
-        last_login_at_gte = pendulum.now().int_timestamp - (60 * 30)
-        params = dict(
-            last_login_at__gte=last_login_at_gte,
-            id__nin=nin_ids,
-            sex=sex,
-            available=True
-        )
-
-        cursor = User.objects(**params).order_by("-last_login_at")
-        size = cursor.count()
+        chunk_size = size * CANDIDATE_OVERFETCH
 
+        presences = iter(Presence.list_online(sex=sex, nin_ids=nin_ids, batch_size=chunk_size))
         result = []
-        for index in range(0, size):
-            user = cursor[index]
-            if self.does_know_each_other(user):
-                self.add_user_knows_me(user)
-                user.add_user_knows_me(self)
-                continue
-            result.append(user.id)
-            if len(result) >= 10:
+        while len(result) < size:
+            user_ids = [presence["user_id"] for presence in itertools.islice(presences, chunk_size)]
+            if not user_ids:
                 break
-        return result
+            available_ids = set(User.list_only_user_ids(id__in=user_ids, available=True))
+            user_ids = [user_id for user_id in user_ids if user_id in available_ids]
+            result.extend(self.pick_user_ids_not_knowing(user_ids, size - len(result)))
+        return result[:size]
 
     @time_lapse
-    def list_user_ids_within_distance(self, distance=5):
+    def list_users_within_distance(self, distance=5, size=10) -> list:
+        """Lists users within the distance ranked by the score, hydrated with the list projection."""
         nin_ids = self._get_nin_ids()
         sex = 'M' if self.sex == 'F' else 'F'
 
         location = self.location["coordinates"] if self.location else [127.0936859, 37.505808]
-        params = dict(
+
+        index = geo_index.get()
+        if index is not None:
+            candidates = index.query(
+                location, distance * 1000, sex,
+                birthed_at_gte=self.birthed_at - (12 * ONE_YEAR_TO_SECONDS),
+                birthed_at_lte=self.birthed_at + (12 * ONE_YEAR_TO_SECONDS),
+                nin_ids=nin_ids)
+            candidates = User._hydrate_geo_candidates(candidates, sex)
+            distance = np.array([candidate["distance"] for candidate in candidates], dtype=np.float64)
+        else:
+            fields = ["id", "location"] + scoring.FEATURE_FIELDS
+            candidates = list(self.query_within_distance(nin_ids, distance).only(*fields).as_pymongo())
+            distance = scoring.distances(location, scoring.coordinates_of(candidates))
+
+        # ranks by scores with a daily seeded jitter, which used to be a daily seeded shuffle.
+        scores = scoring.score(self.to_mongo(), candidates, distance=distance)
+        scores += scoring.jitter(_get_hash(str(self.id)) + 1, len(candidates))
+        user_ids = [candidate["_id"] for candidate in scoring.top_k(candidates, scores)]
+
+        return self.pick_users_not_knowing(user_ids, size)
+
+    def query_within_distance(self, nin_ids: set, distance=5):
+        sex = 'M' if self.sex == 'F' else 'F'
+        location = self.location["coordinates"] if self.location else [127.0936859, 37.505808]
+        return User.objects(
             location__near=location,
             location__max_distance=distance * 1000,  # 1000 = 1 km
             location__min_distance=0 * 1000,
@@ -463,22 +753,27 @@ class User(db.Document):
             available=True
         )
 
-        user_ids = User.list_only_user_ids(**params)
-        random.seed(_get_hash(str(self.id)) + 1)
-        random.shuffle(user_ids)
+    @classmethod
+    def _hydrate_geo_candidates(cls, candidates: list, sex: str) -> list:
+        """Fills scoring features of the geo index candidates, dropping the ones no longer available."""
+        candidate_ids = [candidate["_id"] for candidate in candidates]
+        users = User.objects(id__in=candidate_ids, available=True, sex=sex) \
+            .only("id", *scoring.FEATURE_FIELDS).as_pymongo()
+        users = {user["_id"]: user for user in users}
+        return [dict(users[candidate["_id"]], distance=candidate["distance"])
+                for candidate in candidates if candidate["_id"] in users]
 
-        result = []
-        for user_id in user_ids:
-            user = User.get(id=user_id)
-            if self.does_know_each_other(user):
-                self.add_user_knows_me(user)
-                user.add_user_knows_me(self)
-                continue
-            result.append(user.id)
-            if len(result) >= 10:
-                break
+    @classmethod
+    def list_geo_indexable(cls, user_ids=None) -> list:
+        """Lists available users with the fields of the geo index, only of the given ids if provided."""
+        params = dict(available=True, location__exists=True)
+        if user_ids is not None:
+            params.update(id__in=list(user_ids))
+        return list(User.objects(**params).only(*geo_index.FIELDS).as_pymongo())
 
-        return result
+    def publish_change(self):
+        """Publishes the change of the user to the feed, e.g. the geo index."""
+        UserChange(seq=Sequence.next("user_change"), user_id=self.id, changed_at=pendulum.now()).save()
 
     @classmethod
     def excludes(cls):
@@ -493,6 +788,9 @@ class User(db.Document):
 
     @classmethod
     def get(cls, **kwargs):
+        if list(kwargs.keys()) == ["id"] and ObjectId.is_valid(kwargs["id"]):
+            user = User.load(kwargs["id"])
+            return user if user is not None else abort(404)
         excludes = kwargs.get("excludes", User.excludes())
         return User.objects.exclude(*excludes).get_or_404(**kwargs)
 
@@ -501,10 +799,45 @@ class User(db.Document):
         users = User.objects(**kwargs).exclude(*User.excludes())
         return users
 
+    @classmethod
+    def loader(cls) -> user_loader.UserLoader:
+        """Returns the loader of the request, which loads users with `User.excludes()` projection."""
+        return user_loader.get_loader(lambda user_ids: User.list(id__in=user_ids).as_pymongo())
+
+    @classmethod
+    def load(cls, user_id):
+        """Loads a user document through the loader, None if not found."""
+        user = User.loader().load(user_id)
+        return User._from_son(user) if user is not None else None
+
     @classmethod
     def get_users_dict(cls, user_ids: set):
-        users = User.list(id__in=list(user_ids)).as_pymongo()
-        return {str(user.get("_id")): user for user in users}
+        return User.loader().load_many(user_ids)
+
+    @classmethod
+    def list_cards(cls, user_ids) -> dict:
+        """Returns the public cards of the users by the string of the ids, cached across requests."""
+        return user_card_cache.get_many(
+            user_ids, lambda missed: User.objects(id__in=missed).only(*user_card_cache.CARD_FIELDS).as_pymongo())
+
+    @classmethod
+    def get_card(cls, user_id):
+        return User.list_cards([user_id]).get(str(user_id), None)
+
+    @classmethod
+    def on_saved(cls, sender, document, **kwargs):
+        User.loader().forget(document.id)
+        user_card_cache.invalidate(document.id)
+
+    def update(self, **kwargs):
+        User.loader().forget(self.id)
+        user_card_cache.invalidate(self.id)
+        return super(User, self).update(**kwargs)
+
+    def modify(self, query=None, **update):
+        User.loader().forget(self.id)
+        user_card_cache.invalidate(self.id)
+        return super(User, self).modify(query, **update)
 
     @classmethod
     def get_verified_user(cls, user_id, request):
@@ -528,6 +861,8 @@ class User(db.Document):
         unregister = Unregister(nickname=self.nickname, uid=self.uid, phone=self.phone, user=self)
         unregister.save()
 
+        PhoneIndex.unindex_user(self)
+
         self.uid = None
         self.phone = None
         self.device_token = None
@@ -538,6 +873,8 @@ class User(db.Document):
         self.nickname = "탈퇴 한 회원"
         self.save()
 
+        self.publish_change()
+
         Post.objects(author=self).delete()
         # Comment.objects(owner=user).delete()
         # Request.objects(user_from=user).delete()
@@ -556,6 +893,10 @@ class User(db.Document):
         return setting
 
 
+signals.post_save.connect(User.on_saved, sender=User)
+signals.post_delete.connect(User.on_saved, sender=User)
+
+
 class Unregister(db.Document):
     meta = {
         'strict': False,
@@ -579,10 +920,11 @@ class Comment(db.Document):
         'index_background': INDEX_BACKGROUND,
         'index_cls': INDEX_CLS,
         'auto_create_index': AUTO_CREATE_INDEX,
-        'indexes': ['post_id']
+        'indexes': [('post_id', 'parent_id', '-created_at'), 'parent_id']
     }
     user_id = db.ObjectIdField(required=True)
     post_id = db.ObjectIdField(required=True)
+    parent_id = db.ObjectIdField()  # None for the top level comments of a post
     comment = db.StringField()
     comments = db.ListField(db.ReferenceField('self'), reverse_delete_rule=db.CASCADE)
     created_at = db.LongField(required=True)
@@ -591,58 +933,78 @@ class Comment(db.Document):
     is_deleted = db.BooleanField(default=False)
 
     @classmethod
-    def list_comments(cls, **kwargs):
-        pipe_line = [{
-            "$graphLookup": {
-                "from": "comment",
-                "startWith": "$comments",
-                "connectFromField": "comments",
-                "connectToField": "_id",
-                "as": "children",
-                "maxDepth": 2,
-            }
-        }, {
-            "$project": {
-                "user_id": 1,
-                "comment": 1,
-                "comments": "$children",
-                "thumb_up_user_ids": 1,
-                "thumb_down_user_ids": 1,
-                "created_at": 1,
-                "is_deleted": 1
-            }
-        }]
-        aggregate = Comment.objects(**kwargs).aggregate(pipe_line)
-        result = list(aggregate)
-        result.sort(key=lambda x: x["created_at"], reverse=True)
-        return result
+    def build_comments_of_posts(cls, post_ids, limit=COMMENTS_PER_POST) -> list:
+        """Builds the aggregation of the latest top level comments of each post by a single `$in` match."""
+        return [
+            {"$match": {"post_id": {"$in": list(post_ids)}, "parent_id": None}},
+            {"$sort": {"post_id": 1, "created_at": -1, "_id": -1}},
+            {"$group": {"_id": "$post_id", "comments": {"$push": "$$ROOT"}, "count": {"$sum": 1}}},
+            {"$project": {"comments": {"$slice": ["$comments", limit]}, "count": 1}},
+            {"$addFields": {"comment_ids": "$comments._id"}},
+            {"$lookup": {"from": "comment", "localField": "comment_ids", "foreignField": "parent_id", "as": "replies"}}
+        ]
 
     @classmethod
-    def get_comments_dict(cls, comments=None, **kwargs):
-        comments = comments or Comment.list_comments(**kwargs)
-        comments_dict = {str(comment["_id"]): comment for comment in comments}
-        return comments_dict
+    def list_comments_of_posts(cls, post_ids, limit=COMMENTS_PER_POST) -> dict:
+        """Lists the latest top level comments of each post with their replies in a single aggregation.
+
+        Returns dict(comments, replies, count) by post id, `count` is of all the top level comments of the post.
+        """
+        pipeline = Comment.build_comments_of_posts(post_ids, limit=limit)
+        return {group["_id"]: group for group in Comment.objects.aggregate(pipeline)}
 
     @classmethod
-    def collect_all_user_ids(cls, comments, collector: set = None):
-        collector = collector or set()
-        cls.travel_tree(comments, lambda x: collector.add(x["user_id"]))
-        return collector
+    def list_more_comments(cls, post_id, cursor: str = None, limit=COMMENTS_PER_POST) -> dict:
+        """Lists the top level comments older than the cursor with their replies in a single aggregation."""
+        match = {"post_id": ObjectId(post_id), "parent_id": None}
+        if cursor:
+            created_at, comment_id = Comment.parse_cursor(cursor)
+            match["$or"] = [{"created_at": {"$lt": created_at}}, {"created_at": created_at, "_id": {"$lt": comment_id}}]
+        pipeline = [
+            {"$match": match},
+            {"$sort": {"created_at": -1, "_id": -1}},
+            {"$limit": limit + 1},
+            {"$lookup": {"from": "comment", "localField": "_id", "foreignField": "parent_id", "as": "replies"}}
+        ]
+        comments = list(Comment.objects.aggregate(pipeline))
+        has_more = len(comments) > limit
+        comments = comments[:limit]
+        replies = [reply for comment in comments for reply in comment.pop("replies")]
+
+        flat = []
+        Comment.nest(comments, replies, flat)
+        Comment.swap_user_id_to_object(flat, User.get_users_dict({comment["user_id"] for comment in flat}))
+        return dict(comments=comments, next=Comment.cursor_of(comments[-1]) if has_more else None)
 
     @classmethod
-    def swap_user_id_to_object(cls, comments, users_dict):
-        def delegator(comment):
-            comment["commenter"] = users_dict.get(str(comment["user_id"]), None)
+    def cursor_of(cls, comment) -> str:
+        return "{0}_{1}".format(comment["created_at"], comment["_id"])
 
-        cls.travel_tree(comments, delegator)
+    @classmethod
+    def parse_cursor(cls, cursor: str):
+        """Returns (created_at, comment id) of the cursor, or None if it is malformed."""
+        created_at, _, comment_id = cursor.partition("_")
+        if not created_at.isdigit() or not ObjectId.is_valid(comment_id):
+            return None
+        return int(created_at), ObjectId(comment_id)
+
+    @classmethod
+    def nest(cls, comments: list, replies: list, collector: list) -> list:
+        """Nests the replies under their comments latest first, collecting all of them flat."""
+        children = {}
+        for reply in sorted(replies, key=lambda x: x["created_at"], reverse=True):
+            reply["comments"] = []
+            children.setdefault(reply["parent_id"], []).append(reply)
+        for comment in comments:
+            comment["comments"] = children.get(comment["_id"], [])
+        collector.extend(comments)
+        collector.extend(replies)
         return comments
 
     @classmethod
-    def travel_tree(cls, comments, delegator):
+    def swap_user_id_to_object(cls, comments, users_dict):
         for comment in comments:
-            delegator(comment)
-            if comment["comments"]:
-                cls.travel_tree(comment["comments"], delegator)
+            comment["commenter"] = users_dict.get(str(comment["user_id"]), None)
         return comments
 
 
@@ -659,7 +1021,7 @@ class Post(db.Document):
         'index_background': INDEX_BACKGROUND,
         'index_cls': INDEX_CLS,
         'auto_create_index': AUTO_CREATE_INDEX,
-        'indexes': ['author']
+        'indexes': ['author', ('author_sex', 'is_deleted', '-id')]
     }
     author = db.ReferenceField(User, required=True, reverse_delete_rule=db.CASCADE)
     author_sex = db.StringField(choices=["M", "F"])
@@ -698,63 +1060,38 @@ class Post(db.Document):
         return post
 
     @classmethod
-    def list_posts(cls, limit=30, **kwargs):
-        posts = Post.objects(**kwargs).order_by("-id") \
-            .limit(limit).as_pymongo()
-
-        user_ids = set()
-        comment_ids = set()
-
-        for post in posts:
-            user_ids.add(post["author"])
-            comment_ids.update(post["comments"])
-
-        comments = Comment.list_comments(id__in=comment_ids)
-        commenter_ids = Comment.collect_all_user_ids(comments)
-
-        user_ids.update(commenter_ids)
-        user_dicts = User.get_users_dict(user_ids)
-        comments = Comment.swap_user_id_to_object(comments, user_dicts)
-        comments_dict = Comment.get_comments_dict(comments)
-
-        for post in posts:
-            comments = post["comments"]
-            hierarchy_comments = []
-            for comment_id in comments:
-                hierarchy_comments.append(comments_dict.get(str(comment_id), None))
-            hierarchy_comments.sort(key=lambda x: x["created_at"], reverse=True)
-            post["comments"] = hierarchy_comments
-            post["author"] = user_dicts.get(str(post["author"]), None)
-
+    def list_posts(cls, limit=30, comments_limit=COMMENTS_PER_POST, **kwargs):
+        posts = list(Post.objects(**kwargs).order_by("-id").limit(limit).as_pymongo())
+        Post.hydrate(posts, comments_limit=comments_limit)
         return posts
 
     @classmethod
     def get_post(cls, **kwargs):
         post = Post.objects.get_or_404(**kwargs).to_mongo()
+        Post.hydrate([post])
+        return post
 
-        # returns as hierarchy_comments
-        comments = Comment.list_comments(id__in=post["comments"])
-        # travels hierarchy structure and get all user ids.
-        commenter_ids = Comment.collect_all_user_ids(comments)
+    @classmethod
+    def hydrate(cls, posts: list, comments_limit=COMMENTS_PER_POST):
+        """Swaps the comment ids and the author of the posts with the objects, a page of comments of each."""
+        comments_of_posts = Comment.list_comments_of_posts([post["_id"] for post in posts], limit=comments_limit)
 
-        author_id = str(post["author"])
-        user_ids = {author_id}
-        user_ids.update(commenter_ids)
+        flat = []
+        for post in posts:
+            group = comments_of_posts.get(post["_id"], dict(comments=[], replies=[], count=0))
+            post["comments"] = Comment.nest(group["comments"], group["replies"], flat)
+            post["comments_count"] = group["count"]
+            has_more = group["count"] > len(post["comments"])
+            post["comments_next"] = Comment.cursor_of(post["comments"][-1]) if has_more else None
+
+        user_ids = {post["author"] for post in posts}
+        user_ids.update(comment["user_id"] for comment in flat)
         users_dict = User.get_users_dict(user_ids)
 
-        comments = Comment.swap_user_id_to_object(comments, users_dict)
-        comments_dict = Comment.get_comments_dict(comments)
-
-        post_comments = post["comments"]
-        hierarchy_comments = []
-        for comment_id in post_comments:
-            hierarchy_comments.append(
-                comments_dict.get(str(comment_id), None))
-        hierarchy_comments.sort(key=lambda x: x["created_at"], reverse=True)
-        post["comments"] = hierarchy_comments
-        post["author"] = users_dict.get(author_id)
-
-        return post
+        Comment.swap_user_id_to_object(flat, users_dict)
+        for post in posts:
+            post["author"] = users_dict.get(str(post["author"]), None)
+        return posts
 
     def add_comment(self, comment, parent_id=None):
         if parent_id:
@@ -788,8 +1125,9 @@ class Request(db.Document):
     @classmethod
     def get(cls, **kwargs):
         _request = Request.objects.get_or_404(**kwargs).to_mongo()
-        _request["user_to"] = User.get(id=_request["user_to"]).to_mongo()
-        _request["user_from"] = User.get(id=_request["user_from"]).to_mongo()
+        users_dict = User.get_users_dict({_request["user_to"], _request["user_from"]})
+        _request["user_to"] = users_dict.get(str(_request["user_to"])) or abort(404)
+        _request["user_from"] = users_dict.get(str(_request["user_from"])) or abort(404)
         return _request
 
     @classmethod
@@ -822,7 +1160,7 @@ class StarRating(db.Document):
         'index_background': INDEX_BACKGROUND,
         'index_cls': INDEX_CLS,
         'auto_create_index': AUTO_CREATE_INDEX,
-        'indexes': ['user_from', 'user_to']
+        'indexes': ['user_from', ('user_to', '-rated_at')]
     }
     user_from = db.ReferenceField(User, required=True, reverse_delete_rule=db.CASCADE)
     user_to = db.ReferenceField(User, required=True, reverse_delete_rule=db.CASCADE)
@@ -853,7 +1191,7 @@ class Conversation(db.Document):
         'index_background': INDEX_BACKGROUND,
         'index_cls': INDEX_CLS,
         'auto_create_index': AUTO_CREATE_INDEX,
-        'indexes': ['participants']
+        'indexes': ['participants', ('participants', '-last_activity_at')]
     }
     title = db.StringField(max_length=500)
     participants = db.SortedListField(db.ReferenceField(User), reverse_delete_rule=db.CASCADE)
@@ -862,6 +1200,115 @@ class Conversation(db.Document):
     created_at = db.LongField(required=True)
     available = db.BooleanField(required=True, default=False)
     available_at = db.LongField()
+    # summaries of the list, kept along with the messages added.
+    last_message = db.EmbeddedDocumentField(EmbeddedMessage)
+    last_activity_at = db.LongField()
+    unread_counts = db.DictField()
+
+    def clean(self):
+        self.last_activity_at = self.last_activity_at or self.created_at
+
+    def add_message(self, message: EmbeddedMessage) -> EmbeddedMessage:
+        """Appends the message, then updates the summaries counting it unread for the others."""
+        MessageBucket.push(self.id, message)
+        params = {"inc__unread_counts__{0}".format(participant.id): 1
+                  for participant in self.participants if str(participant.id) != str(message.user_id)}
+        Conversation.objects(id=self.id).update_one(
+            set__last_message=message, max__last_activity_at=message.created_at, **params)
+        return message
+
+    def mark_read(self, user: User):
+        Conversation.objects(id=self.id).update_one(**{"set__unread_counts__{0}".format(user.id): 0})
+
+    @classmethod
+    def list_summaries(cls, user: User) -> list:
+        """Lists conversations of the user by the last activity, without the messages."""
+        conversations = Conversation.objects(participants=user).exclude("messages").order_by("-last_activity_at")
+        return list(conversations.as_pymongo())
+
+    def list_messages(self, before=None, limit=MESSAGES_PER_PAGE) -> list:
+        return MessageBucket.list_messages(self.id, before=before, limit=limit)
+
+    def list_messages_since(self, since, limit=MESSAGES_PER_PAGE) -> list:
+        return MessageBucket.list_messages_since(self.id, since, limit=limit)
+
+
+class MessageBucket(db.Document):
+    meta = {
+        'strict': False,
+        'queryset_class': fm.BaseQuerySet,
+        'index_opts': INDEX_OPTS,
+        'index_background': INDEX_BACKGROUND,
+        'index_cls': INDEX_CLS,
+        'auto_create_index': AUTO_CREATE_INDEX,
+        'indexes': [('conversation_id', '-last_id')]
+    }
+    # removed along with the conversation by every path of deletes, including the ones by queries.
+    conversation_id = db.ReferenceField(Conversation, required=True, reverse_delete_rule=db.CASCADE)
+    first_id = db.ObjectIdField()
+    last_id = db.ObjectIdField()
+    count = db.IntField(default=0)
+    messages = db.EmbeddedDocumentListField(EmbeddedMessage)
+
+    @classmethod
+    def push(cls, conversation_id, message: EmbeddedMessage) -> EmbeddedMessage:
+        """Appends a message into the bucket not full yet, a new bucket is upserted when all are full."""
+        MessageBucket._get_collection().update_one(
+            {"conversation_id": ObjectId(conversation_id), "count": {"$lt": MESSAGES_PER_BUCKET}},
+            {"$push": {"messages": message.to_mongo()},
+             "$inc": {"count": 1},
+             "$min": {"first_id": message.id},
+             "$max": {"last_id": message.id}},
+            upsert=True)
+        return message
+
+    @classmethod
+    def insert_messages(cls, conversation_id, messages: list):
+        """Inserts messages in order as full buckets, used by the migration."""
+        buckets = []
+        for index in range(0, len(messages), MESSAGES_PER_BUCKET):
+            chunk = messages[index:index + MESSAGES_PER_BUCKET]
+            buckets.append(dict(
+                conversation_id=ObjectId(conversation_id),
+                first_id=min(message["id"] for message in chunk),
+                last_id=max(message["id"] for message in chunk),
+                count=len(chunk),
+                messages=chunk))
+        if buckets:
+            MessageBucket._get_collection().insert_many(buckets)
+
+    @classmethod
+    def list_messages(cls, conversation_id, before=None, limit=MESSAGES_PER_PAGE) -> list:
+        """Lists messages newest first, older than the message of `before` id if given."""
+        params = dict(conversation_id=conversation_id)
+        if before is not None:
+            params.update(first_id__lt=ObjectId(before))
+        buckets = MessageBucket.objects(**params).order_by("-last_id").only("last_id", "messages").as_pymongo()
+
+        messages = []
+        for bucket in buckets:
+            # buckets may overlap, e.g. appended while migrated, so read on until none can be newer.
+            if len(messages) >= limit and bucket["last_id"] < messages[limit - 1]["id"]:
+                break
+            messages.extend(message for message in bucket["messages"]
+                            if before is None or message["id"] < ObjectId(before))
+            messages.sort(key=lambda message: message["id"], reverse=True)
+        return messages[:limit]
+
+    @classmethod
+    def list_messages_since(cls, conversation_id, since, limit=MESSAGES_PER_PAGE) -> list:
+        """Lists messages newer than the message of `since` id oldest first, to catch up from it."""
+        since = ObjectId(since)
+        buckets = MessageBucket.objects(conversation_id=conversation_id, last_id__gt=since) \
+            .order_by("first_id").only("first_id", "messages").as_pymongo()
+
+        messages = []
+        for bucket in buckets:
+            if len(messages) >= limit and bucket["first_id"] > messages[limit - 1]["id"]:
+                break
+            messages.extend(message for message in bucket["messages"] if message["id"] > since)
+            messages.sort(key=lambda message: message["id"])
+        return messages[:limit]
 
 
 class _Event(object):
@@ -916,13 +1363,14 @@ class AlarmRecord(db.EmbeddedDocument):
     created_at = db.LongField(required=True)
     is_read = db.BooleanField()
 
-    def as_dict(self, user: User = None):
-        user = user or User.objects.get(id=self.user_id)
+    def as_dict(self, card: dict = None):
+        card = card or User.get_card(self.user_id)
+        if card is None:
+            raise User.DoesNotExist("Not found a user({0}).".format(self.user_id))
 
         event = self.event
-        nickname = user.nickname or ""
-        user_image = next(iter(user.user_images or []), None)
-        image_url = user_image.url if user_image else ""
+        nickname = card["nickname"]
+        image_url = card["image_url"]
 
         push_id = self.id
         user_id = self.user_id
@@ -954,6 +1402,11 @@ class AlarmRecord(db.EmbeddedDocument):
 
 
 class Alarm(db.Document):
+    class MarkReadResult(object):
+        MARKED = "MARKED"
+        NOT_FOUND = "NOT_FOUND"
+        CONFLICT = "CONFLICT"
+
     meta = {
         'strict': False,
         'queryset_class': fm.BaseQuerySet,
@@ -969,6 +1422,8 @@ class Alarm(db.Document):
 
     owner = db.ReferenceField(User, required=True, reverse_delete_rule=db.CASCADE, unique=True)
     records = db.SortedListField(db.EmbeddedDocumentField(AlarmRecord), ordering="created_at", reverse=True)
+    # counts records pushed since read, which may include ones sliced out of the inbox.
+    unread_count = db.IntField(default=0)
 
     @classmethod
     def create_alarm(cls,
@@ -979,17 +1434,13 @@ class Alarm(db.Document):
                      post=None,
                      comment=None,
                      request=None,
-                     message=None):
+                     message=None) -> AlarmRecord:
 
         current_time_stamp = pendulum.now().int_timestamp
 
         if not user_to or not user_from:
             raise Exception("Both user_from and user_to are required values.")
 
-        alarm = Alarm.objects(owner=user_to).first()
-        if not alarm:
-            alarm = Alarm(owner=user_to).save()
-
         push = AlarmRecord(
             event=event,
             user_id=user_from.id,
@@ -1001,11 +1452,66 @@ class Alarm(db.Document):
             created_at=current_time_stamp
         )
 
-        alarm.records = alarm.records[:199]  # max 200
-        alarm.records.append(push)
-        alarm.save()
+        # newest first, only the latest ones are kept.
+        Alarm._get_collection().update_one(
+            {"owner": user_to.id},
+            {"$push": {"records": {
+                "$each": [push.to_mongo()],
+                "$sort": {"created_at": -1, "id": -1},
+                "$slice": ALARM_RECORDS_LIMIT}},
+             "$inc": {"unread_count": 1}},
+            upsert=True)
+
+        return push
+
+    @classmethod
+    def list_records(cls, owner: User, before=None, limit=ALARM_RECORDS_LIMIT) -> list:
+        """Lists records newest first, older than the record of `before` id if given."""
+        alarm = Alarm.objects(owner=owner).only("records").first()
+        records = alarm.records if alarm else []
+        if before is not None:
+            index = next((index for index, record in enumerate(records) if str(record.id) == str(before)), None)
+            records = records[index + 1:] if index is not None else []
+        return records[:limit]
+
+    @classmethod
+    def get_unread_count(cls, owner: User) -> int:
+        alarm = Alarm.objects(owner=owner).only("unread_count").as_pymongo().first()
+        return min((alarm or {}).get("unread_count", 0), ALARM_RECORDS_LIMIT)
+
+    @classmethod
+    def build_mark_read(cls, up_to: int = None, unread_count: int = 0):
+        """Builds the update marking records read, created up to the timestamp if given, and its array filters."""
+        array_filter = {"record.is_read": {"$ne": True}}
+        if up_to is not None:
+            array_filter["record.created_at"] = {"$lte": up_to}
+        update = {"$set": {"records.$[record].is_read": True, "unread_count": unread_count}}
+        return update, [array_filter]
 
-        return alarm
+    @classmethod
+    def mark_read(cls, owner: User, up_to: int = None) -> str:
+        """Marks records read and resets the unread counter in a single write, returns `MarkReadResult`."""
+        collection = Alarm._get_collection()
+        for _ in range(ALARM_MARK_READ_ATTEMPTS):
+            query = {"owner": owner.id}
+            unread_count = 0
+            if up_to is not None:
+                # the ones newer than the timestamp stay unread, counted unless a record is pushed meanwhile.
+                alarm = collection.find_one(query, {"records.id": 1, "records.created_at": 1, "records.is_read": 1})
+                if alarm is None:
+                    return Alarm.MarkReadResult.NOT_FOUND
+                records = alarm.get("records", [])
+                unread_count = len([record for record in records
+                                    if record["created_at"] > up_to and not record.get("is_read")])
+                query["records.0.id"] = records[0]["id"] if records else None
+            update, array_filters = Alarm.build_mark_read(up_to, unread_count)
+            if collection.update_one(query, update, array_filters=array_filters).matched_count:
+                return Alarm.MarkReadResult.MARKED
+            # matched by the owner only, so the user has no alarm.
+            if up_to is None:
+                return Alarm.MarkReadResult.NOT_FOUND
+        # records kept being pushed meanwhile.
+        return Alarm.MarkReadResult.CONFLICT
 
 
 class Recommendation(db.Document):
@@ -1022,6 +1528,8 @@ class Recommendation(db.Document):
     user_ids = db.ListField(db.ObjectIdField())
     users = db.ListField(db.ReferenceField(User))
     last_recommended_at = db.LongField(required=True)
+    next_user_ids = db.ListField(db.ObjectIdField())  # precomputed by the nightly batch
+    next_recommended_for = db.StringField()  # date of `next_user_ids` e.g. 2020-05-21
 
 
 class Payment(db.Document):
@@ -1049,6 +1557,64 @@ class Payment(db.Document):
     purchase_time_ms = db.LongField()
 
 
+class Balance(db.Document):
+    """Materialized point balance of a user, the sum of the payments as the ledger."""
+    meta = {
+        'strict': False,
+        'queryset_class': fm.BaseQuerySet,
+        'index_opts': INDEX_OPTS,
+        'index_background': INDEX_BACKGROUND,
+        'index_cls': INDEX_CLS,
+        'auto_create_index': AUTO_CREATE_INDEX,
+        'indexes': ['owner']
+    }
+    owner = db.ReferenceField(User, required=True, reverse_delete_rule=db.CASCADE, unique=True)
+    balance = db.IntField(required=True, default=0)
+    updated_at = db.LongField(required=True)
+
+    @classmethod
+    def sum_payments(cls, user: User) -> int:
+        payments = Payment.objects(owner=user).only("amount").as_pymongo()
+        return sum(payment.get("amount", 0) for payment in payments)
+
+    @classmethod
+    def get_balance(cls, user: User) -> int:
+        """Returns the balance, initializing it with the sum of the payments at the first time."""
+        balance = Balance.objects(owner=user).only("balance").as_pymongo().first()
+        if balance is not None:
+            return balance["balance"]
+
+        # the balance is created before any payment written from now on, so it misses none of them.
+        Balance.objects(owner=user).update_one(
+            set_on_insert__balance=Balance.sum_payments(user),
+            set_on_insert__updated_at=pendulum.now().int_timestamp,
+            upsert=True)
+        return Balance.objects(owner=user).only("balance").as_pymongo().first()["balance"]
+
+    @classmethod
+    def deposit(cls, user: User, amount: int) -> int:
+        balance = Balance.objects(owner=user).modify(
+            inc__balance=amount, set__updated_at=pendulum.now().int_timestamp, new=True)
+        return balance.balance
+
+    @classmethod
+    def withdraw(cls, user: User, amount: int):
+        """Withdraws only if the balance is enough in a single update, returns None otherwise."""
+        Balance.get_balance(user)
+        balance = Balance.objects(owner=user, balance__gte=amount).modify(
+            inc__balance=-amount, set__updated_at=pendulum.now().int_timestamp, new=True)
+        return balance.balance if balance else None
+
+    @classmethod
+    def list_mismatches(cls) -> list:
+        """Lists (owner id, balance, sum of the payments) of the balances not matching the ledger."""
+        ledger = Payment.objects.aggregate([{"$group": {"_id": "$owner", "amount": {"$sum": "$amount"}}}])
+        ledger = {payment["_id"]: payment["amount"] for payment in ledger}
+        balances = Balance.objects.only("owner", "balance").as_pymongo()
+        return [(balance["owner"], balance["balance"], ledger.get(balance["owner"], 0))
+                for balance in balances if balance["balance"] != ledger.get(balance["owner"], 0)]
+
+
 class Contact(db.Document):
     meta = {
         'strict': False,
@@ -1063,6 +1629,285 @@ class Contact(db.Document):
     phones = db.ListField(db.StringField(required=True))
     user_ids_know_me = db.ListField(db.ObjectIdField())
     last_updated_at = db.LongField(required=True)
+    version = db.IntField(default=0)  # increased on every change of phones
+
+    @classmethod
+    def at_version(cls, owner, version):
+        if version:
+            return Contact.objects(owner=owner, version=version)
+        return Contact.objects(db.Q(version=0) | db.Q(version__exists=False), owner=owner)
+
+
+class Exclusion(db.Document):
+    """Incrementally maintained nin ids of the discovery endpoints."""
+    meta = {
+        'strict': False,
+        'queryset_class': fm.BaseQuerySet,
+        'index_opts': INDEX_OPTS,
+        'index_background': INDEX_BACKGROUND,
+        'index_cls': INDEX_CLS,
+        'auto_create_index': AUTO_CREATE_INDEX,
+        'indexes': ['owner']
+    }
+    owner = db.ReferenceField(User, required=True, reverse_delete_rule=db.CASCADE, unique=True)
+    user_ids = db.ListField(db.ObjectIdField())
+    updated_at = db.LongField(required=True)
+
+
+class PhoneIndex(db.Document):
+    """Reverse index of contacts, from a hashed phone to its registered user and the owners having it."""
+    meta = {
+        'strict': False,
+        'queryset_class': fm.BaseQuerySet,
+        'index_opts': INDEX_OPTS,
+        'index_background': INDEX_BACKGROUND,
+        'index_cls': INDEX_CLS,
+        'auto_create_index': AUTO_CREATE_INDEX,
+        'indexes': ['phone_hash']
+    }
+    phone_hash = db.StringField(required=True, unique=True)
+    user_id = db.ObjectIdField()  # the registered user of the phone
+    owner_ids = db.ListField(db.ObjectIdField())  # users having the phone in their contacts
+
+    @classmethod
+    def index_owner(cls, owner_id, added_phones=None, removed_phones=None):
+        added_hashes = {phone_service.hash_phone(phone) for phone in added_phones or []}
+        removed_hashes = {phone_service.hash_phone(phone) for phone in removed_phones or []} - added_hashes
+        operations = [
+            UpdateOne({"phone_hash": phone_hash}, {"$addToSet": {"owner_ids": owner_id}}, upsert=True)
+            for phone_hash in added_hashes
+        ]
+        operations.extend(
+            UpdateOne({"phone_hash": phone_hash}, {"$pull": {"owner_ids": owner_id}})
+            for phone_hash in removed_hashes
+        )
+        if operations:
+            PhoneIndex._get_collection().bulk_write(operations, ordered=False)
+
+    @classmethod
+    def index_user(cls, user: User):
+        if not user.phone:
+            return
+        phone_hash = phone_service.hash_phone(user.phone)
+        PhoneIndex.objects(phone_hash=phone_hash).update_one(set__user_id=user.id, upsert=True)
+
+    @classmethod
+    def unindex_user(cls, user: User):
+        if not user.phone:
+            return
+        phone_hash = phone_service.hash_phone(user.phone)
+        PhoneIndex.objects(phone_hash=phone_hash, user_id=user.id).update_one(unset__user_id=True)
+
+    @classmethod
+    def list_owner_ids_having(cls, phone, among=None) -> set:
+        """Lists users having the phone in their contacts, only `among` the given ids if provided."""
+        phone_hash = phone_service.hash_phone(phone)
+        index = PhoneIndex.objects(phone_hash=phone_hash).only("owner_ids").as_pymongo().first()
+        owner_ids = set(index.get("owner_ids", [])) if index else set()
+        return owner_ids & set(among) if among is not None else owner_ids
+
+    @classmethod
+    def list_user_ids_of(cls, phones) -> set:
+        """Lists registered users of the phones."""
+        phone_hashes = list({phone_service.hash_phone(phone) for phone in phones})
+        if not phone_hashes:
+            return set()
+        indexes = PhoneIndex.objects(phone_hash__in=phone_hashes, user_id__exists=True).only("user_id").as_pymongo()
+        return {index["user_id"] for index in indexes}
+
+
+class Presence(db.Document):
+    """Heartbeats of users, removed by the TTL index when they go offline."""
+    meta = {
+        'strict': False,
+        'queryset_class': fm.BaseQuerySet,
+        'index_opts': INDEX_OPTS,
+        'index_background': INDEX_BACKGROUND,
+        'index_cls': INDEX_CLS,
+        'auto_create_index': AUTO_CREATE_INDEX,
+        'indexes': [
+            {'fields': ['seen_at'], 'expireAfterSeconds': PRESENCE_TTL},
+            ('sex', '-seen_at')
+        ]
+    }
+    user_id = db.ObjectIdField(required=True, unique=True)
+    sex = db.StringField()
+    seen_at = db.DateTimeField(required=True)
+
+    @classmethod
+    def beat(cls, user: User):
+        Presence.objects(user_id=user.id).update_one(set__sex=user.sex, set__seen_at=pendulum.now(), upsert=True)
+
+    @classmethod
+    def list_online(cls, sex, nin_ids=None, batch_size=50):
+        """Returns a cursor of users online latest first, which is read lazily by batches."""
+        # the TTL monitor runs once a minute, so expired ones can be still there.
+        seen_at_gte = pendulum.now().subtract(seconds=PRESENCE_TTL)
+        params = dict(sex=sex, seen_at__gte=seen_at_gte)
+        if nin_ids:
+            params.update(user_id__nin=list(nin_ids))
+        return Presence.objects(**params).order_by("-seen_at").only("user_id").as_pymongo().batch_size(batch_size)
+
+
+class StreamSubscription(db.Document):
+    """Conversations streamed to users right now, whom pushes are not needed for."""
+    meta = {
+        'strict': False,
+        'queryset_class': fm.BaseQuerySet,
+        'index_opts': INDEX_OPTS,
+        'index_background': INDEX_BACKGROUND,
+        'index_cls': INDEX_CLS,
+        'auto_create_index': AUTO_CREATE_INDEX,
+        'indexes': [
+            {'fields': ['seen_at'], 'expireAfterSeconds': STREAM_SUBSCRIPTION_TTL},
+            ('conversation_id', 'user_id')
+        ]
+    }
+    conversation_id = db.ObjectIdField(required=True)
+    user_id = db.ObjectIdField(required=True)
+    seen_at = db.DateTimeField(required=True)
+
+    @classmethod
+    def beat(cls, conversation_id, user_id):
+        StreamSubscription.objects(conversation_id=conversation_id, user_id=user_id).update_one(
+            set__seen_at=pendulum.now(), upsert=True)
+
+    @classmethod
+    def leave(cls, conversation_id, user_id):
+        StreamSubscription.objects(conversation_id=conversation_id, user_id=user_id).delete()
+
+    @classmethod
+    def list_streaming_user_ids(cls, conversation_id) -> set:
+        # the TTL monitor runs once a minute, so expired ones can be still there.
+        seen_at_gte = pendulum.now().subtract(seconds=STREAM_SUBSCRIPTION_TTL)
+        subscriptions = StreamSubscription.objects(conversation_id=conversation_id, seen_at__gte=seen_at_gte)
+        return {subscription["user_id"] for subscription in subscriptions.only("user_id").as_pymongo()}
+
+
+class StreamEvent(db.Document):
+    """Events of conversations, tailed by every worker to fan out to the streams it holds."""
+    meta = {
+        'strict': False,
+        'queryset_class': fm.BaseQuerySet,
+        'index_cls': INDEX_CLS,
+        'auto_create_index': AUTO_CREATE_INDEX,
+        'max_documents': STREAM_EVENTS_MAX_DOCUMENTS,
+        'max_size': STREAM_EVENTS_MAX_SIZE
+    }
+    seq = db.LongField(required=True)
+    conversation_id = db.ObjectIdField(required=True)
+    data = db.DictField()
+
+
+class PushOutbox(db.Document):
+    """Pushes queued by requests, sent by the dispatcher threads in batches."""
+    meta = {
+        'strict': False,
+        'queryset_class': fm.BaseQuerySet,
+        'index_opts': INDEX_OPTS,
+        'index_background': INDEX_BACKGROUND,
+        'index_cls': INDEX_CLS,
+        'auto_create_index': AUTO_CREATE_INDEX,
+        'indexes': [
+            {'fields': ['created_at'], 'expireAfterSeconds': PUSH_OUTBOX_TTL},
+            ('status', 'available_at'),
+            ('status', 'locked_until')
+        ]
+    }
+
+    class Status(object):
+        PENDING = "PENDING"
+        PROCESSING = "PROCESSING"
+        SENT = "SENT"
+        FAILED = "FAILED"
+
+    user_id = db.ObjectIdField(required=True)
+    data = db.DictField()
+    priority = db.StringField(default="normal")
+    status = db.StringField(required=True, default=Status.PENDING, choices=[
+        Status.PENDING, Status.PROCESSING, Status.SENT, Status.FAILED])
+    attempts = db.IntField(default=0)
+    error = db.StringField()
+    created_at = db.DateTimeField(required=True)
+    available_at = db.DateTimeField(required=True)
+    locked_until = db.DateTimeField()
+
+    @classmethod
+    def enqueue(cls, user: User, data: dict, priority="normal") -> "PushOutbox":
+        now = pendulum.now()
+        return PushOutbox(user_id=user.id, data=data, priority=priority, created_at=now, available_at=now).save()
+
+    @classmethod
+    def claim(cls, lease: int):
+        """Takes a pending push or the one of which lease has expired, e.g. by a worker killed while sending."""
+        now = pendulum.now()
+        query = db.Q(status=PushOutbox.Status.PENDING, available_at__lte=now) | \
+            db.Q(status=PushOutbox.Status.PROCESSING, locked_until__lt=now)
+        return PushOutbox.objects(query).order_by("available_at").modify(
+            set__status=PushOutbox.Status.PROCESSING, set__locked_until=now.add(seconds=lease),
+            inc__attempts=1, new=True)
+
+    def done(self):
+        self.update(set__status=PushOutbox.Status.SENT, unset__locked_until=True)
+
+    def fail(self, error: str, retry_in: int = None):
+        """Retries in seconds if given, otherwise gives it up."""
+        if retry_in is None:
+            self.update(set__status=PushOutbox.Status.FAILED, set__error=error, unset__locked_until=True)
+        else:
+            self.update(set__status=PushOutbox.Status.PENDING, set__error=error, unset__locked_until=True,
+                        set__available_at=pendulum.now().add(seconds=retry_in))
+
+
+class Sequence(db.Document):
+    """Counters incremented by the server, monotonic unlike the ids generated by the clients."""
+    meta = {
+        'strict': False,
+        'queryset_class': fm.BaseQuerySet,
+        'index_opts': INDEX_OPTS,
+        'index_background': INDEX_BACKGROUND,
+        'index_cls': INDEX_CLS,
+        'auto_create_index': AUTO_CREATE_INDEX
+    }
+    name = db.StringField(primary_key=True)
+    value = db.LongField(default=0)
+
+    @classmethod
+    def next(cls, name) -> int:
+        sequence = Sequence._get_collection().find_one_and_update(
+            {"_id": name}, {"$inc": {"value": 1}}, upsert=True, return_document=ReturnDocument.AFTER)
+        return sequence["value"]
+
+    @classmethod
+    def current(cls, name) -> int:
+        sequence = Sequence._get_collection().find_one({"_id": name})
+        return sequence["value"] if sequence else 0
+
+
+class UserChange(db.Document):
+    """Feed of changed users numbered by the sequence, kept for a day."""
+    meta = {
+        'strict': False,
+        'queryset_class': fm.BaseQuerySet,
+        'index_opts': INDEX_OPTS,
+        'index_background': INDEX_BACKGROUND,
+        'index_cls': INDEX_CLS,
+        'auto_create_index': AUTO_CREATE_INDEX,
+        'indexes': ['seq', {'fields': ['changed_at'], 'expireAfterSeconds': 60 * 60 * 24}]
+    }
+    seq = db.LongField(required=True)
+    user_id = db.ObjectIdField(required=True)
+    changed_at = db.DateTimeField(required=True)
+
+    @classmethod
+    def list_since(cls, seq, limit=5000) -> list:
+        """Lists (seq, user id) changed after the seq in order."""
+        changes = UserChange.objects(seq__gt=seq).order_by("seq").limit(limit).as_pymongo()
+        return [(change["seq"], change["user_id"]) for change in changes]
+
+    @classmethod
+    def last_seq(cls) -> int:
+        return Sequence.current("user_change")
 
 
 class Admin(db.Document):
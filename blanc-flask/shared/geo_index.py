@@ -0,0 +1,288 @@
+"""In-memory grid index of available users, shared across gunicorn workers through shared memory.
+
+A snapshot is a structured array of available users sorted by (sex, grid cell) key, published as a shared memory
+segment per generation. The header segment points the current generation and workers re-attach on change.
+A worker holding the file lock keeps it current by applying the feed of changed users, with a full build hourly.
+"""
+
+import fcntl
+import logging
+import math
+import numpy as np
+import os
+import tempfile
+import threading
+import time
+
+from bson.objectid import ObjectId
+from multiprocessing import resource_tracker
+from multiprocessing import shared_memory
+from shared import scoring
+
+CELL_DEGREES = 0.1  # about 11 km of latitude
+ROWS = int(180 / CELL_DEGREES)
+COLUMNS = int(360 / CELL_DEGREES)
+CELLS = ROWS * COLUMNS
+SEXES = {"M": 0, "F": 1}
+METERS_PER_DEGREE = 111320
+
+DTYPE = np.dtype([
+    ("key", "<i8"),
+    ("id", "S12"),
+    ("lng", "<f8"),
+    ("lat", "<f8"),
+    ("birthed_at", "<i8"),
+    ("star_rating_avg", "<f8")
+])
+HEADER_DTYPE = np.dtype([("generation", "<i8"), ("built_at", "<i8"), ("last_change_seq", "<i8")])
+COUNT_DTYPE = np.dtype("<i8")
+
+NAME = "blanc_geo_index"
+LOCK_PATH = os.path.join(tempfile.gettempdir(), "{0}.lock".format(NAME))
+REFRESH_INTERVAL = 30  # seconds
+FULL_BUILD_INTERVAL = 60 * 60  # seconds
+# a seq is taken before its change is written, so a smaller one may show up late,
+# the recent ones are read again along with new ones.
+CHANGE_SEQ_OVERLAP = 100
+FIELDS = ["id", "sex", "location", "birthed_at", "star_rating_avg"]
+
+_local = dict(pid=None, generation=None, index=None, header=None)
+_lock = threading.RLock()
+
+
+def _to_object_id(value: bytes) -> ObjectId:
+    # numpy strips trailing null bytes of fixed size bytes.
+    return ObjectId(bytes(value).ljust(12, b"\0"))
+
+
+def _cells_of(lngs: np.ndarray, lats: np.ndarray) -> np.ndarray:
+    rows = np.clip(((lats + 90) / CELL_DEGREES).astype(np.int64), 0, ROWS - 1)
+    columns = np.clip(((lngs + 180) / CELL_DEGREES).astype(np.int64), 0, COLUMNS - 1)
+    return rows * COLUMNS + columns
+
+
+def pack(users) -> np.ndarray:
+    """Packs users as pymongo documents of `FIELDS` into records sorted by the key."""
+    users = [user for user in users
+             if user.get("sex") in SEXES and (user.get("location") or {}).get("coordinates")]
+    records = np.zeros(len(users), dtype=DTYPE)
+    if not users:
+        return records
+
+    coordinates = np.array([user["location"]["coordinates"] for user in users], dtype=np.float64)
+    sexes = np.array([SEXES[user["sex"]] for user in users], dtype=np.int64)
+    records["id"] = [user["_id"].binary for user in users]
+    records["lng"], records["lat"] = coordinates[:, 0], coordinates[:, 1]
+    records["birthed_at"] = [user.get("birthed_at") or 0 for user in users]
+    records["star_rating_avg"] = [user.get("star_rating_avg") or 0 for user in users]
+    records["key"] = sexes * CELLS + _cells_of(records["lng"], records["lat"])
+    records.sort(order="key", kind="stable")
+    return records
+
+
+def merge(records: np.ndarray, removed_ids, added: np.ndarray) -> np.ndarray:
+    """Replaces records of removed ids with added ones, keeping the key order."""
+    removed = np.array([ObjectId(user_id).binary for user_id in removed_ids], dtype="S12")
+    merged = np.concatenate([records[~np.isin(records["id"], removed)], added])
+    merged.sort(order="key", kind="stable")
+    return merged
+
+
+class GeoIndex(object):
+
+    def __init__(self, records: np.ndarray, segment=None):
+        self.records = records
+        # keeps the segment mapped as long as the records are in use.
+        self.segment = segment
+
+    def __len__(self):
+        return len(self.records)
+
+    def query(self, origin, max_distance, sex,
+              birthed_at_gte=None, birthed_at_lte=None, star_rating_min=None, nin_ids=None, limit=None) -> list:
+        """Lists users within `max_distance` meters nearest first.
+
+        `star_rating_min` is a value or a function of distances returning the minimum of each.
+        """
+        lng, lat = origin
+        delta_lat = max_distance / METERS_PER_DEGREE
+        delta_lng = delta_lat / max(math.cos(math.radians(lat)), 0.01)
+        row_from, row_to = [int(np.clip((x + 90) / CELL_DEGREES, 0, ROWS - 1)) for x in (lat - delta_lat, lat + delta_lat)]
+        column_from, column_to = [int(np.clip((x + 180) / CELL_DEGREES, 0, COLUMNS - 1))
+                                  for x in (lng - delta_lng, lng + delta_lng)]
+
+        keys = self.records["key"]
+        base = SEXES[sex] * CELLS
+        bounds = np.array([[base + row * COLUMNS + column_from, base + row * COLUMNS + column_to]
+                           for row in range(row_from, row_to + 1)], dtype=np.int64)
+        starts = np.searchsorted(keys, bounds[:, 0], side="left")
+        ends = np.searchsorted(keys, bounds[:, 1], side="right")
+        candidates = np.concatenate([self.records[start:end] for start, end in zip(starts, ends)] or [self.records[:0]])
+
+        distance = scoring.distances(origin, np.column_stack([candidates["lng"], candidates["lat"]]))
+        mask = distance <= max_distance
+        if birthed_at_gte is not None:
+            mask &= candidates["birthed_at"] >= birthed_at_gte
+        if birthed_at_lte is not None:
+            mask &= candidates["birthed_at"] <= birthed_at_lte
+        if star_rating_min is not None:
+            threshold = star_rating_min(distance) if callable(star_rating_min) else star_rating_min
+            mask &= candidates["star_rating_avg"] >= threshold
+        if nin_ids:
+            nin = np.array([ObjectId(user_id).binary for user_id in nin_ids], dtype="S12")
+            mask &= ~np.isin(candidates["id"], nin)
+
+        candidates, distance = candidates[mask], distance[mask]
+        order = np.argsort(distance, kind="stable")[:limit]
+        return [dict(_id=_to_object_id(candidate["id"]),
+                     distance=float(candidate_distance),
+                     birthed_at=int(candidate["birthed_at"]),
+                     star_rating_avg=float(candidate["star_rating_avg"]))
+                for candidate, candidate_distance in zip(candidates[order], distance[order])]
+
+
+def _untrack(segment):
+    # segments must survive the worker creating or attaching them.
+    try:
+        resource_tracker.unregister(segment._name, "shared_memory")
+    except Exception:
+        pass
+
+
+def _segment_name(generation):
+    return "{0}_{1}".format(NAME, generation)
+
+
+def _open(name, size=None):
+    try:
+        if size is None:
+            segment = shared_memory.SharedMemory(name=name)
+        else:
+            segment = shared_memory.SharedMemory(name=name, create=True, size=size)
+    except FileNotFoundError:
+        return None
+    _untrack(segment)
+    return segment
+
+
+def _unlink(name):
+    segment = _open(name)
+    if segment:
+        segment.close()
+        segment.unlink()
+
+
+def _header():
+    with _lock:
+        if _local["pid"] != os.getpid():
+            _local.update(pid=os.getpid(), generation=None, index=None, header=None)
+        if _local["header"] is None:
+            segment = _open(NAME)
+            if segment is None:
+                return None
+            _local["header"] = (np.ndarray((1,), dtype=HEADER_DTYPE, buffer=segment.buf), segment)
+        return _local["header"][0]
+
+
+def publish(records: np.ndarray, built_at: int, last_change_seq: int):
+    """Publishes records as the next generation, the caller must hold the lock."""
+    header = _header()
+    if header is None:
+        segment = _open(NAME, size=HEADER_DTYPE.itemsize)
+        segment.buf[:] = bytes(HEADER_DTYPE.itemsize)
+        segment.close()
+        header = _header()
+
+    generation = int(header["generation"][0]) + 1
+    segment = _open(_segment_name(generation), size=COUNT_DTYPE.itemsize + max(records.nbytes, 1))
+    np.ndarray((1,), dtype=COUNT_DTYPE, buffer=segment.buf)[0] = len(records)
+    np.ndarray(records.shape, dtype=DTYPE, buffer=segment.buf, offset=COUNT_DTYPE.itemsize)[:] = records
+    segment.close()
+
+    header["built_at"][0] = built_at
+    header["last_change_seq"][0] = last_change_seq
+    header["generation"][0] = generation
+    # readers may still be attaching to the previous one.
+    _unlink(_segment_name(generation - 2))
+
+
+def get():
+    """Returns the current index, or None if it has not been published yet."""
+    header = _header()
+    if header is None:
+        return None
+
+    with _lock:
+        generation = int(header["generation"][0])
+        if generation != _local["generation"]:
+            segment = _open(_segment_name(generation))
+            if segment is None:
+                return _local["index"]
+            count = int(np.ndarray((1,), dtype=COUNT_DTYPE, buffer=segment.buf)[0])
+            records = np.ndarray((count,), dtype=DTYPE, buffer=segment.buf, offset=COUNT_DTYPE.itemsize)
+            _local.update(generation=generation, index=GeoIndex(records, segment))
+        return _local["index"]
+
+
+def refresh(list_users, list_changes, last_change_seq) -> bool:
+    """Builds or updates the index with the feed, only by the one holding the lock.
+
+    `list_users(user_ids=None)` lists available users with `FIELDS`, all of them when user ids are not given.
+    `list_changes(after)` lists (seq, user id) of users changed after the seq in order.
+    `last_change_seq()` returns the last seq issued to the feed.
+    """
+    with open(LOCK_PATH, "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+
+        header = _header()
+        index = get()
+        now = int(time.time())
+        if index is None or now - int(header["built_at"][0]) >= FULL_BUILD_INTERVAL:
+            # changes issued before the build are reflected by the build itself.
+            seq = last_change_seq()
+            publish(pack(list_users()), now, seq)
+            return True
+
+        seq = int(header["last_change_seq"][0])
+        changes = list_changes(max(seq - CHANGE_SEQ_OVERLAP, 0))
+        if not [change for change in changes if change[0] > seq]:
+            return False
+
+        # applying a change again is harmless, the users are listed as they are now.
+        user_ids = {user_id for _, user_id in changes}
+        records = merge(index.records, user_ids, pack(list_users(user_ids)))
+        publish(records, int(header["built_at"][0]), max(seq, changes[-1][0]))
+        return True
+
+
+def start(app, list_users, list_changes, last_change_seq):
+    """Starts refreshing the index in a daemon thread of this process."""
+
+    def run():
+        while True:
+            try:
+                with app.app_context():
+                    refresh(list_users, list_changes, last_change_seq)
+                get()
+            except Exception as e:
+                logging.exception(e)
+            time.sleep(REFRESH_INTERVAL)
+
+    thread = threading.Thread(target=run, name=NAME, daemon=True)
+    thread.start()
+    return thread
+
+
+def unlink():
+    """Removes all the segments, when the server exits."""
+    with _lock:
+        header = _header()
+        if header is None:
+            return
+        generation = int(header["generation"][0])
+        for name in [_segment_name(generation - 1), _segment_name(generation), NAME]:
+            _unlink(name)
+        _local.update(generation=None, index=None, header=None)
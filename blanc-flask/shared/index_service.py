@@ -0,0 +1,79 @@
+"""Declared indexes of the documents, synced and explained by `manage.py indexes`."""
+
+import mongoengine as db
+
+from bson.objectid import ObjectId
+from model import models
+from model.models import User, Post, Presence, Request, StarRating, Conversation, Alarm, Contact, Comment
+from model.models import PhoneIndex, Exclusion
+from shared import phone_service
+
+
+def list_documents() -> list:
+    """Lists the documents declared in models, which own their indexes in meta."""
+    documents = [value for value in vars(models).values()
+                 if isinstance(value, type) and issubclass(value, db.Document)
+                 and value.__module__ == models.__name__ and not value._meta.get("abstract")]
+    return sorted(documents, key=lambda document: document.__name__)
+
+
+def sync(document, drop=False) -> dict:
+    """Creates the missing indexes in the background, dropping the undeclared ones if `drop`."""
+    diff = document.compare_indexes()
+    document.ensure_indexes()
+    if drop and diff["extra"]:
+        collection = document._get_collection()
+        for name, info in collection.index_information().items():
+            if name != "_id_" and info["key"] in diff["extra"]:
+                collection.drop_index(name)
+    return diff
+
+
+def list_hot_queries(user: User) -> list:
+    """Lists (name, explain) of the representative queries on behalf of the user."""
+    sex = 'M' if user.sex == 'F' else 'F'
+    nin_ids = {user.id}
+    pipeline = user.build_recommendation_pipeline(nin_ids)
+    phone_hash = phone_service.hash_phone(user.phone or "+821000000000")
+
+    def explain_aggregate(document, pipeline):
+        return document._get_db().command(
+            "aggregate", document._get_collection_name(), pipeline=pipeline, explain=True)
+
+    return [
+        ("users by uid", lambda: User.objects(uid=user.uid).explain()),
+        ("users by phone", lambda: User.objects(phone__in=[user.phone]).explain()),
+        ("users within distance", lambda: user.query_within_distance(nin_ids).explain()),
+        ("recommendation candidates", lambda: explain_aggregate(User, pipeline)),
+        ("users online", lambda: Presence.list_online(sex=sex, nin_ids=nin_ids).explain()),
+        ("post feed", lambda: Post.objects(author_sex=sex, is_deleted=False).order_by("-id").limit(30).explain()),
+        ("posts of user", lambda: Post.objects(author=user.id, is_deleted=False).order_by("-id").explain()),
+        ("comments of post", lambda: Comment.objects(post_id=ObjectId()).explain()),
+        ("requests to user", lambda: Request.objects(user_to=user).explain()),
+        ("star ratings to user", lambda: StarRating.objects(user_to=user).order_by("-rated_at").explain()),
+        ("conversations of user", lambda: Conversation.objects(participants=user).explain()),
+        ("alarm of user", lambda: Alarm.objects(owner=user).explain()),
+        ("contact of user", lambda: Contact.objects(owner=user).explain()),
+        ("exclusion of user", lambda: Exclusion.objects(owner=user).explain()),
+        ("phone index", lambda: PhoneIndex.objects(phone_hash=phone_hash).explain()),
+    ]
+
+
+def list_stages(explain: dict) -> list:
+    """Lists the stages of the winning plans in an explain output, of a find or an aggregate."""
+    stages = []
+
+    def walk(value):
+        if isinstance(value, dict):
+            for key, child in value.items():
+                if key == "rejectedPlans":
+                    continue
+                if key == "stage" and isinstance(child, str):
+                    stages.append(child)
+                walk(child)
+        elif isinstance(value, list):
+            for child in value:
+                walk(child)
+
+    walk(explain)
+    return stages
@@ -1,25 +1,35 @@
 import logging
 from firebase_admin import messaging
+from flask import current_app as app
 from model.models import Alarm, Setting, User
+from shared import push_outbox
 
 
 def push(data: dict = None, user: User = None, priority="normal"):
     if not user or not user.device_token:
         return
     try:
-        apns = build_apns()
-        message = messaging.Message(
-            data=data,
-            token=user.device_token,
-            apns=apns,
-            android=messaging.AndroidConfig(priority=priority)
-        )
-        progress(message=message, data=data, user=user)
-        messaging.send(message)
+        if app.config["PUSH_DISPATCH"] == "outbox":
+            # sent by the dispatcher threads, see shared/push_outbox.py
+            push_outbox.enqueue(user, data, priority=priority)
+            return
+        messaging.send(build_message(data, user, priority))
     except Exception as e:
         logging.exception(e)
 
 
+def build_message(data: dict, user: User, priority="normal") -> messaging.Message:
+    apns = build_apns()
+    message = messaging.Message(
+        data=data,
+        token=user.device_token,
+        apns=apns,
+        android=messaging.AndroidConfig(priority=priority)
+    )
+    progress(message=message, data=data, user=user)
+    return message
+
+
 def progress(message: messaging.Message, data: dict = None, user: User = None):
     if is_event(of=Alarm.Event.LOG_OUT, data=data):
         log_out(message=message, data=data, user=user)
@@ -0,0 +1,24 @@
+import re
+
+from shared import regex
+from shared.hash_service import sha256
+
+PHONE_PREFIX_PATTERN = re.compile(regex.PHONE_PREFIX_REGEX)
+
+GLOBAL_PHONE_PATTERN = re.compile(regex.GLOBAL_PHONE_REGEX)
+
+
+def normalize(phone: str):
+    """Normalizes `+82010..` into `+8210..` as the sms verification does."""
+    return PHONE_PREFIX_PATTERN.sub("+8210", phone.strip())
+
+
+def hash_phone(phone: str):
+    return sha256(normalize(phone))
+
+
+def normalize_all(phones) -> list:
+    """Normalizes phones in a batch, dropping invalid ones and duplicates in order."""
+    match = GLOBAL_PHONE_PATTERN.match
+    normalized = (normalize(phone) for phone in phones if isinstance(phone, str))
+    return list(dict.fromkeys(phone for phone in normalized if match(phone)))
@@ -0,0 +1,115 @@
+"""Dispatcher of the push outbox, sending queued pushes in batches by background threads of each worker."""
+
+import logging
+import threading
+import time
+
+from firebase_admin import exceptions
+from firebase_admin import messaging
+from model.models import PushOutbox, User
+
+PUSH_WORKERS = 2
+BATCH_SIZE = 100  # up to 500 by FCM
+POLL_INTERVAL = 1  # seconds
+LEASE = 60  # seconds, a push being sent longer than this is taken again
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 2  # seconds, doubled by the attempts
+# the token is not valid anymore, so retries never succeed.
+PERMANENT_ERRORS = (messaging.UnregisteredError, messaging.SenderIdMismatchError, exceptions.InvalidArgumentError)
+
+_wake = threading.Event()
+_lock = threading.Lock()
+_stats = dict(enqueued=0, sent=0, retried=0, failed=0, batches=0, last_batch_seconds=0)
+
+
+def enqueue(user: User, data: dict, priority="normal"):
+    PushOutbox.enqueue(user, data, priority=priority)
+    _count(enqueued=1)
+    _wake.set()
+
+
+def claim_batch(size=BATCH_SIZE) -> list:
+    pushes = []
+    for _ in range(size):
+        push = PushOutbox.claim(LEASE)
+        if push is None:
+            break
+        pushes.append(push)
+    return pushes
+
+
+def dispatch(build) -> int:
+    """Sends a batch of pushes, `build(data, user, priority)` builds the message of each. Returns the number sent."""
+    pushes = claim_batch()
+    if not pushes:
+        return 0
+
+    started_at = time.time()
+    users = User.objects.only("id", "device_token").in_bulk([push.user_id for push in pushes])
+    messages, sending = [], []
+    for push in pushes:
+        user = users.get(push.user_id, None)
+        if not user or not user.device_token:
+            push.fail("The user or the device token is gone.")
+            _count(failed=1)
+            continue
+        try:
+            messages.append(build(push.data, user, push.priority))
+            sending.append(push)
+        except Exception as e:
+            logging.exception(e)
+            push.fail(repr(e))
+            _count(failed=1)
+
+    responses = messaging.send_all(messages).responses if messages else []
+    for push, response in zip(sending, responses):
+        if response.success:
+            push.done()
+            _count(sent=1)
+        elif isinstance(response.exception, PERMANENT_ERRORS) or push.attempts >= MAX_ATTEMPTS:
+            push.fail(repr(response.exception))
+            _count(failed=1)
+        else:
+            push.fail(repr(response.exception), retry_in=BACKOFF_BASE ** push.attempts)
+            _count(retried=1)
+    _count(batches=1)
+    with _lock:
+        _stats["last_batch_seconds"] = time.time() - started_at
+    return len([response for response in responses if response.success])
+
+
+def start(app, build, workers=PUSH_WORKERS):
+    """Starts the dispatcher threads of this process."""
+
+    def run():
+        while True:
+            try:
+                with app.app_context():
+                    while dispatch(build):
+                        pass
+            except Exception as e:
+                logging.exception(e)
+            # woken up by the pushes enqueued in this process, the ones of the others are polled.
+            _wake.wait(POLL_INTERVAL)
+            _wake.clear()
+
+    threads = [threading.Thread(target=run, name="push_outbox_{0}".format(index), daemon=True)
+               for index in range(workers)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def _count(**counts):
+    with _lock:
+        for key, count in counts.items():
+            _stats[key] += count
+
+
+def stats() -> dict:
+    with _lock:
+        result = dict(_stats)
+    result.update(
+        pending=PushOutbox.objects(status=PushOutbox.Status.PENDING).count(),
+        processing=PushOutbox.objects(status=PushOutbox.Status.PROCESSING).count())
+    return result
@@ -0,0 +1,94 @@
+"""Nightly batch precomputing the next day recommendations of available users."""
+
+import json
+import logging
+import multiprocessing
+import os
+import pendulum
+
+from model.models import User, RECOMMENDATION_TIMEZONE
+
+
+def next_date():
+    return str(pendulum.tomorrow(RECOMMENDATION_TIMEZONE).date())
+
+
+def load_checkpoint(path, date):
+    if path and os.path.exists(path):
+        with open(path) as f:
+            checkpoint = json.load(f)
+        if checkpoint.get("date") == date:
+            return checkpoint
+    return dict(date=date, last_user_id=None, processed=0, failed=0)
+
+
+def save_checkpoint(path, checkpoint):
+    if not path:
+        return
+    temp_path = "{0}.tmp".format(path)
+    with open(temp_path, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(temp_path, path)
+
+
+def generate(user_id, date) -> bool:
+    try:
+        user = User.objects(id=user_id).first()
+        if user:
+            user.prepare_next_recommendation(date)
+        return True
+    except Exception as e:
+        logging.exception(e)
+        return False
+
+
+def _generate(args):
+    return generate(*args)
+
+
+def _init_worker(config):
+    from app import create_app
+    app = create_app(config=config, firebase=False)
+    app.app_context().push()
+
+
+def run(date=None, config=None, chunk_size=500, processes=0, checkpoint_path=None, echo=print):
+    """Precomputes recommendations by chunks of users ordered by id, saving a checkpoint after each chunk.
+
+    Runs in the current process when `processes` is 0, otherwise `config` is required to connect workers.
+    """
+    date = date or next_date()
+    checkpoint = load_checkpoint(checkpoint_path, date)
+    total = User.objects(available=True).count()
+
+    pool = None
+    if processes:
+        context = multiprocessing.get_context("spawn")
+        pool = context.Pool(processes, initializer=_init_worker, initargs=(config,))
+
+    try:
+        while True:
+            params = dict(available=True)
+            if checkpoint["last_user_id"]:
+                params["id__gt"] = checkpoint["last_user_id"]
+            users = User.objects(**params).order_by("id").only("id").limit(chunk_size).as_pymongo()
+            user_ids = [user["_id"] for user in users]
+            if not user_ids:
+                break
+
+            tasks = [(user_id, date) for user_id in user_ids]
+            results = pool.map(_generate, tasks) if pool else [_generate(task) for task in tasks]
+
+            checkpoint["last_user_id"] = str(user_ids[-1])
+            checkpoint["processed"] += len(results)
+            checkpoint["failed"] += results.count(False)
+            save_checkpoint(checkpoint_path, checkpoint)
+
+            echo("{processed}/{total} users processed for {date} ({failed} failed)..".format(
+                total=total, **checkpoint))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    return checkpoint
@@ -0,0 +1,107 @@
+"""Scores discovery candidates with NumPy in a single vectorized pass."""
+
+import numpy as np
+import pendulum
+
+EARTH_RADIUS = 6371000  # meters
+
+DISTANCE_SCALE = 30 * 1000  # meters
+AGE_DELTA_SCALE = 12 * 31556926  # seconds
+LAST_LOGIN_SCALE = 7 * 24 * 60 * 60  # seconds
+MAX_STAR_RATING = 5
+
+WEIGHTS = dict(
+    distance=0.35,
+    age=0.15,
+    star_rating=0.25,
+    last_login=0.15,
+    overlap=0.10
+)
+
+FEATURE_FIELDS = ["birthed_at", "star_rating_avg", "last_login_at", "interest_ids", "charm_ids"]
+
+
+def distances(origin, coordinates: np.ndarray) -> np.ndarray:
+    """Haversine distances in meters from the origin [lng, lat] to (n, 2) coordinates."""
+    if not len(coordinates):
+        return np.zeros(0)
+    lng, lat = np.radians(origin[0]), np.radians(origin[1])
+    lngs, lats = np.radians(coordinates[:, 0]), np.radians(coordinates[:, 1])
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lngs - lng) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+def coordinates_of(candidates: list) -> np.ndarray:
+    """Packs `location` of candidates into a (n, 2) array, a candidate without it is placed at nowhere."""
+    coordinates = np.full((len(candidates), 2), np.nan)
+    for index, candidate in enumerate(candidates):
+        location = candidate.get("location") or {}
+        if location.get("coordinates"):
+            coordinates[index] = location["coordinates"]
+    return coordinates
+
+
+def _column(candidates: list, field: str, default=0) -> np.ndarray:
+    values = (candidate.get(field) for candidate in candidates)
+    return np.fromiter(
+        (default if value is None else value for value in values), dtype=np.float64, count=len(candidates))
+
+
+def _multi_hot(candidates: list, fields, size: int) -> np.ndarray:
+    matrix = np.zeros((len(candidates), size), dtype=np.float64)
+    for field in fields:
+        rows, columns = [], []
+        for index, candidate in enumerate(candidates):
+            ids = [i for i in candidate.get(field) or [] if 0 <= i < size]
+            rows.extend([index] * len(ids))
+            columns.extend(ids)
+        matrix[rows, columns] = 1
+    return matrix
+
+
+def score(me: dict, candidates: list, distance: np.ndarray = None, weights: dict = None) -> np.ndarray:
+    """Scores candidates in [0, 1] each.
+
+    Distances in meters are taken from `distance` of candidates unless they are given as an array.
+    """
+    weights = weights or WEIGHTS
+    if not candidates:
+        return np.zeros(0)
+
+    now = pendulum.now().int_timestamp
+    if distance is None:
+        distance = _column(candidates, "distance", default=np.inf)
+    age_delta = np.abs(_column(candidates, "birthed_at") - (me.get("birthed_at") or 0))
+    star_rating = _column(candidates, "star_rating_avg")
+    last_login_delta = np.maximum(now - _column(candidates, "last_login_at"), 0)
+
+    overlap_fields = ["interest_ids", "charm_ids"]
+    my_ids = [i for field in overlap_fields for i in me.get(field) or [] if i >= 0]
+    size = max(my_ids) + 1 if my_ids else 0
+    if size:
+        my_vector = _multi_hot([me], overlap_fields, size)[0]
+        overlap = _multi_hot(candidates, overlap_fields, size) @ my_vector / my_vector.sum()
+    else:
+        overlap = np.zeros(len(candidates))
+
+    scores = weights["distance"] * np.exp(-np.nan_to_num(distance, nan=np.inf) / DISTANCE_SCALE) \
+        + weights["age"] * (1 - np.clip(age_delta / AGE_DELTA_SCALE, 0, 1)) \
+        + weights["star_rating"] * np.clip(star_rating / MAX_STAR_RATING, 0, 1) \
+        + weights["last_login"] * np.exp(-last_login_delta / LAST_LOGIN_SCALE) \
+        + weights["overlap"] * overlap
+    return scores
+
+
+def jitter(seed: int, size: int, scale=0.1) -> np.ndarray:
+    """Seeded noise to add on scores, which varies orders among close scores by the seed."""
+    return np.random.RandomState(seed % (2 ** 32)).uniform(0, scale, size)
+
+
+def top_k(candidates: list, scores: np.ndarray, k: int = None) -> list:
+    """Returns top k candidates ordered by the score, all of them if k is not provided."""
+    k = len(candidates) if k is None else min(k, len(candidates))
+    if k <= 0:
+        return []
+    indexes = np.argpartition(-scores, k - 1)[:k]
+    indexes = indexes[np.argsort(-scores[indexes], kind="stable")]
+    return [candidates[index] for index in indexes]
@@ -0,0 +1,65 @@
+"""Relations of the session payload, built by parallel projected queries and cached shortly per user."""
+
+import threading
+
+from cachetools import TTLCache
+from concurrent.futures import ThreadPoolExecutor
+from model.models import User, Balance, Request, StarRating
+from mongoengine.queryset.visitor import Q
+
+# each worker has its own cache, so the writes in the other workers show up within this at most.
+SESSION_TTL = 30  # seconds
+REQUEST_THREADS = 32  # threads of a worker, see gunicorn_config.py
+SESSION_QUERIES = 3  # run in parallel by each request
+
+_cache = TTLCache(maxsize=10000, ttl=SESSION_TTL)
+_lock = threading.Lock()
+# every request thread fans out at once without waiting for the others.
+_executor = ThreadPoolExecutor(max_workers=REQUEST_THREADS * SESSION_QUERIES, thread_name_prefix="session")
+
+
+def get_relations(user: User) -> dict:
+    """Returns the ids of the users matched, requested and rated, and the point of the user."""
+    with _lock:
+        relations = _cache.get(user.id)
+    if relations is not None:
+        return relations
+
+    point = _executor.submit(Balance.get_balance, user)
+    star_ratings = _executor.submit(
+        lambda: list(StarRating.objects(user_from=user.id).only("user_to", "score").as_pymongo()))
+    requests = _executor.submit(
+        lambda: list(Request.objects(Q(user_to=user.id) | Q(user_from=user.id))
+                     .only("user_from", "user_to", "response").as_pymongo()))
+
+    received = [req for req in requests.result() if req["user_to"] == user.id]
+    sent = [req for req in requests.result() if req["user_from"] == user.id]
+
+    # 이미 성사 된 상대
+    matched_request_sent = [str(req["user_to"]) for req in sent if req.get("response") == 1]
+    matched_request_received = [str(req["user_from"]) for req in received if req.get("response") == 1]
+    # 성사 되지 않은 상대
+    unmatched_request_sent = [str(req["user_to"]) for req in sent if req.get("response") == 0]
+    unmatched_request_received = [str(req["user_from"]) for req in received if req.get("response") == 0]
+
+    relations = dict(
+        user_ids_matched=matched_request_received + matched_request_sent,
+        user_ids_unmatched=unmatched_request_sent + unmatched_request_received,
+        # 이미 좋아요를 보냄
+        user_ids_i_sent_request=[str(req["user_to"]) for req in sent if req.get("response") != 1],
+        # 내게 좋아요를 보냄 and 미수락
+        user_ids_sent_me_request=[str(req["user_from"]) for req in received if req.get("response") != 1],
+        # 내가 평가 한 사람들
+        star_ratings_i_rated=[dict(user_id=str(x["user_to"]), score=x["score"]) for x in star_ratings.result()],
+        point=point.result()
+    )
+    with _lock:
+        _cache[user.id] = relations
+    return relations
+
+
+def invalidate(*users):
+    """Drops the cached relations of the users, on writes of requests, ratings and payments."""
+    with _lock:
+        for user in users:
+            _cache.pop(user.id if isinstance(user, User) else user, None)
@@ -0,0 +1,111 @@
+"""Fan-out of conversation events to the streams held by workers.
+
+`LocalHub` delivers within this process only, a stand-in for tests and a single worker.
+`MongoHub` publishes into a capped collection tailed by every worker, so the streams held by any worker get them.
+"""
+
+import collections
+import logging
+import queue
+import threading
+import time
+
+from flask import current_app as app
+from pymongo import CursorType
+from model.models import Sequence, StreamEvent
+
+STREAM_QUEUE_SIZE = 100
+TAIL_RETRY_INTERVAL = 1  # seconds
+# a seq is taken before its event is written, so a smaller one may be written late and the recent ones are read again.
+TAIL_SEQ_OVERLAP = 100
+
+_hub = None
+_lock = threading.Lock()
+
+
+class LocalHub(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+
+    def subscribe(self, conversation_id) -> queue.Queue:
+        subscriber = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.setdefault(str(conversation_id), set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, conversation_id, subscriber: queue.Queue):
+        with self._lock:
+            subscribers = self._subscribers.get(str(conversation_id), set())
+            subscribers.discard(subscriber)
+            if not subscribers:
+                self._subscribers.pop(str(conversation_id), None)
+
+    def publish(self, conversation_id, data: dict):
+        self.dispatch(conversation_id, data)
+
+    def dispatch(self, conversation_id, data: dict):
+        with self._lock:
+            subscribers = list(self._subscribers.get(str(conversation_id), []))
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(data)
+            except queue.Full:
+                # the client catches up by the last event id when it reconnects.
+                logging.warning("Dropped an event of a stalled stream of conversation({0}).".format(conversation_id))
+
+
+class MongoHub(LocalHub):
+
+    def __init__(self):
+        super(MongoHub, self).__init__()
+        self._tailing = None
+
+    def subscribe(self, conversation_id) -> queue.Queue:
+        self._start()
+        return super(MongoHub, self).subscribe(conversation_id)
+
+    def publish(self, conversation_id, data: dict):
+        # dispatched by the tailing of every worker including this one.
+        StreamEvent._get_collection().insert_one(
+            dict(seq=Sequence.next("stream_event"), conversation_id=conversation_id, data=data))
+
+    def _start(self):
+        with self._lock:
+            # threads do not survive forks of gunicorn workers.
+            if self._tailing is not None and self._tailing.is_alive():
+                return
+            self._tailing = threading.Thread(target=self._tail, name="stream_hub", daemon=True)
+            self._tailing.start()
+
+    def _tail(self):
+        collection = StreamEvent._get_collection()
+        recent = collection.find({}, {"seq": 1}).sort("$natural", -1).limit(TAIL_SEQ_OVERLAP)
+        # the ones written before this started are not dispatched.
+        dispatched = collections.deque(reversed([event.get("seq", 0) for event in recent]), maxlen=TAIL_SEQ_OVERLAP)
+        last_seq = max(dispatched, default=0)
+        while True:
+            try:
+                query = {"seq": {"$gt": last_seq - TAIL_SEQ_OVERLAP}}
+                cursor = collection.find(query, cursor_type=CursorType.TAILABLE_AWAIT)
+                # a tailable cursor dies on an empty collection, so it is opened again shortly.
+                while cursor.alive:
+                    for event in cursor:
+                        if event["seq"] in dispatched:
+                            continue
+                        dispatched.append(event["seq"])
+                        last_seq = max(last_seq, event["seq"])
+                        self.dispatch(event["conversation_id"], event["data"])
+            except Exception as e:
+                logging.exception(e)
+            time.sleep(TAIL_RETRY_INTERVAL)
+
+
+def get() -> LocalHub:
+    """Returns the hub of this process, of `STREAM_HUB` config."""
+    global _hub
+    with _lock:
+        if _hub is None:
+            _hub = MongoHub() if app.config["STREAM_HUB"] == "mongo" else LocalHub()
+        return _hub
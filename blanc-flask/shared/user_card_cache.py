@@ -0,0 +1,72 @@
+"""Per worker cache of user cards, the public fields of users rendered in feeds, lists and alarms."""
+
+import threading
+
+from bson.objectid import ObjectId
+from cachetools import TTLCache
+
+# each worker has its own cache, so the writes in the other workers show up within this at most.
+CARD_TTL = 60  # seconds
+CARD_CACHE_SIZE = 20000
+CARD_FIELDS = ["nickname", "user_images", "birthed_at", "sex", "area", "star_rating_avg"]
+
+_cache = TTLCache(maxsize=CARD_CACHE_SIZE, ttl=CARD_TTL)
+_lock = threading.Lock()
+_stats = dict(hits=0, misses=0, invalidations=0)
+
+
+def to_card(user: dict) -> dict:
+    """Builds a card from a pymongo document of `CARD_FIELDS`."""
+    user_image = next(iter(sorted(user.get("user_images") or [], key=lambda image: image.get("index", 0))), None)
+    return dict(
+        _id=user["_id"],
+        nickname=user.get("nickname") or "",
+        image_url=user_image.get("url", "") if user_image else "",
+        birthed_at=user.get("birthed_at"),
+        sex=user.get("sex"),
+        area=user.get("area"),
+        star_rating_avg=user.get("star_rating_avg") or 0)
+
+
+def get_many(user_ids, fetch) -> dict:
+    """Returns the cards by the string of the ids, `fetch(user_ids)` lists the users missed with `CARD_FIELDS`."""
+    user_ids = {ObjectId(user_id) for user_id in user_ids if user_id is not None}
+    with _lock:
+        cards = {user_id: _cache.get(user_id) for user_id in user_ids}
+    missed = [user_id for user_id, card in cards.items() if card is None]
+
+    if missed:
+        fetched = {user["_id"]: to_card(user) for user in fetch(missed)}
+        cards.update(fetched)
+        with _lock:
+            _cache.update(fetched)
+
+    with _lock:
+        _stats["hits"] += len(user_ids) - len(missed)
+        _stats["misses"] += len(missed)
+    return {str(user_id): card for user_id, card in cards.items() if card is not None}
+
+
+def invalidate(*user_ids):
+    """Drops the cards of the users, on writes of the profile, images, status and ratings."""
+    with _lock:
+        for user_id in user_ids:
+            if user_id is not None and _cache.pop(ObjectId(user_id), None) is not None:
+                _stats["invalidations"] += 1
+
+
+def clear():
+    with _lock:
+        _cache.clear()
+        _stats.update(hits=0, misses=0, invalidations=0)
+
+
+def stats() -> dict:
+    with _lock:
+        lookups = _stats["hits"] + _stats["misses"]
+        return dict(
+            _stats,
+            size=len(_cache),
+            maxsize=_cache.maxsize,
+            ttl=CARD_TTL,
+            hit_rate=_stats["hits"] / lookups if lookups else 0)
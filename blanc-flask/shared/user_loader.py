@@ -0,0 +1,55 @@
+"""Request scoped identity map of users, batching the pending lookups into a single `$in` query."""
+
+from bson.objectid import ObjectId
+from flask import g
+from flask import has_request_context
+
+
+class UserLoader(object):
+
+    def __init__(self, fetch):
+        # fetch(user_ids) returns the users of the ids as pymongo documents.
+        self._fetch = fetch
+        self._users = {}
+        self._pending = set()
+
+    def prime(self, user_ids):
+        """Queues the ids to be loaded together with the next lookup."""
+        user_ids = {ObjectId(user_id) for user_id in user_ids if user_id is not None}
+        self._pending.update(user_id for user_id in user_ids if user_id not in self._users)
+
+    def load_many(self, user_ids) -> dict:
+        """Returns the users found by the string of the ids."""
+        user_ids = {ObjectId(user_id) for user_id in user_ids if user_id is not None}
+        self.prime(user_ids)
+        self._flush()
+        return {str(user_id): self._users[user_id] for user_id in user_ids if self._users.get(user_id) is not None}
+
+    def load(self, user_id):
+        return self.load_many([user_id]).get(str(user_id), None)
+
+    def forget(self, user_id):
+        self._users.pop(ObjectId(user_id), None)
+
+    def _flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, set()
+        for user in self._fetch(list(pending)):
+            self._users[user["_id"]] = user
+        for user_id in pending:
+            self._users.setdefault(user_id, None)
+
+
+def get_loader(fetch) -> UserLoader:
+    """Returns the loader of the current request, or a new one out of requests."""
+    if not has_request_context():
+        return UserLoader(fetch)
+    if "user_loader" not in g:
+        g.user_loader = UserLoader(fetch)
+    return g.user_loader
+
+
+def teardown(exception=None):
+    # an app context may outlive requests, e.g. in tests and commands.
+    g.pop("user_loader", None)
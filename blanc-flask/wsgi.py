@@ -1,5 +1,9 @@
 from app import create_app
 from config import QaConfig, ProdConfig, DevConfig
+from model.models import User, UserChange
+from shared import geo_index
+from shared import message_service
+from shared import push_outbox
 import os
 
 env = os.environ.get("OP_ENV", "dev")
@@ -13,3 +17,11 @@ else:
     config = DevConfig
 
 app = create_app(config=config)
+
+if app.config["GEO_INDEX_ENABLED"]:
+    # built by the first worker booted, then kept current with the feed of changed users.
+    geo_index.start(app, list_users=User.list_geo_indexable, list_changes=UserChange.list_since,
+                    last_change_seq=UserChange.last_seq)
+
+if app.config["PUSH_DISPATCH"] == "outbox":
+    push_outbox.start(app, build=message_service.build_message)